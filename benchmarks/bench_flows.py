@@ -0,0 +1,297 @@
+"""
+Бенчмарк рассылок и отчетов через fake Bot API (benchmarks.fake_api) с задержкой, 429 и 403.
+База заполняется точками, задачами и отчетами за months месяцев, каждый сценарий повторяется repeat раз.
+
+    python -m benchmarks.bench_flows --cafes 50 --months 6
+    python -m benchmarks.bench_flows --scenarios send_task,report_confirm --rate-limit 0.05 --forbidden 0.1
+    python -m benchmarks.bench_flows --json after.json --compare before.json
+
+Рассылки упираются в лимиты services.broadcast (BROADCAST_GLOBAL_RATE, BROADCAST_CHAT_RATE) - как в проде.
+--json сохраняет итоги, --compare печатает разницу с сохраненными ранее (например, на другом коммите).
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks.common import setup_env, seed, summarize, print_summary
+
+# Сценарий возвращает (времена в мс, количество операций, время замера в с.)
+SCENARIOS = {}
+
+
+def scenario(name: str, unit: str = 'оп'):
+    def decorator(func):
+        SCENARIOS[name] = (func, unit)
+        return func
+    return decorator
+
+
+class Context:
+    def __init__(self, api, bot, send_list: dict, repeat: int):
+        self.api = api
+        self.bot = bot
+        self.send_list = send_list
+        self.repeat = repeat
+        self.failed: Counter = Counter()  # Ожидаемые ошибки: точка заблокировала бота (403)
+        self.errors: Counter = Counter()  # Остальные ошибки - бенчмарк завершается с ошибкой
+        from config_data.conf import tz
+        self.today = datetime.datetime.now(tz=tz).date()
+
+    def days(self):
+        """Разные дни для повторов: ключ идемпотентности очереди включает дату"""
+        return [self.today - datetime.timedelta(days=num) for num in range(1, self.repeat + 1)]
+
+
+@scenario('send_task', 'точек')
+async def bench_send_task(ctx: Context):
+    """Утренняя рассылка задач всем точкам: постановка в очередь и доставка"""
+    import main
+    from config_data.conf import tz
+    from services.jobs import job_book
+    from services.outbox import outbox
+
+    timings = []
+    for day in ctx.days():
+        started = time.perf_counter()
+        await main.send_task(ctx.bot, job_book.jobs['morning'], ctx.send_list, day, tz)
+        await outbox.drain(ctx.bot)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, len(ctx.send_list) * len(timings), sum(timings) / 1000
+
+
+@scenario('send_task_planned', 'точек')
+async def bench_send_task_planned(ctx: Context):
+    """Утренняя рассылка по заранее собранному плану: в замер входит только отправка"""
+    import main
+    from config_data.conf import tz
+    from services.jobs import job_book
+    from services.outbox import outbox
+
+    job = job_book.jobs['morning']
+    timings = []
+    for day in ctx.days():
+        day -= datetime.timedelta(days=ctx.repeat)
+        await main.plan_task(job, ctx.send_list, day, tz, datetime.datetime.now(tz=tz))
+        started = time.perf_counter()
+        await main.send_task(ctx.bot, job, ctx.send_list, day, tz)
+        await outbox.drain(ctx.bot)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, len(ctx.send_list) * len(timings), sum(timings) / 1000
+
+
+@scenario('expired_cafe', 'проверок')
+async def bench_expired_cafe(ctx: Context):
+    """Поиск точек без утреннего отчета"""
+    from services.reports import get_day_compliance
+
+    timings = []
+    for day in ctx.days():
+        started = time.perf_counter()
+        await get_day_compliance(('утро',), day, cafes=ctx.send_list)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, len(timings), sum(timings) / 1000
+
+
+@scenario('evening_checks', 'точек')
+async def bench_evening_checks(ctx: Context):
+    """Вечерняя проверка (вечер и бар): запрос, уведомления точкам и отчет админам"""
+    import main
+    from config_data.conf import tz
+    from services.jobs import job_book
+    from services.outbox import outbox
+
+    timings = []
+    for day in ctx.days():
+        started = time.perf_counter()
+        await main.check_reports(ctx.bot, job_book.jobs['expired_evening'], ctx.send_list, day, tz)
+        await outbox.drain(ctx.bot)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, len(ctx.send_list) * len(timings), sum(timings) / 1000
+
+
+@scenario('last_days_report', 'отчетов')
+async def bench_last_days_report(ctx: Context):
+    """Отчет о пропусках за 30 дней"""
+    from services.db_func import get_last_days_report
+
+    timings = []
+    for _ in range(ctx.repeat):
+        started = time.perf_counter()
+        await get_last_days_report('утро', 30)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, len(timings), sum(timings) / 1000
+
+
+def confirm_update(update_id: int, tg_id: str, name: str, data: str) -> dict:
+    user = {'id': int(tg_id), 'is_bot': False, 'first_name': name, 'username': f'cafe{tg_id[-4:]}'}
+    chat = {'id': int(tg_id), 'type': 'private'}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': tg_id, 'data': data,
+        'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat,
+                    'text': f'{name}\nБлюдо 1\nБлюдо 2'}}}
+
+
+@scenario('report_confirm', 'апдейтов')
+async def bench_report_confirm(ctx: Context):
+    """Все точки одновременно нажимают "Отправить отчет" с тремя фото в черновике"""
+    from aiogram import Dispatcher
+    from aiogram.exceptions import TelegramForbiddenError
+    from aiogram.types import Update
+    from handlers import admin_handlers, user_handlers
+    from handlers.user_handlers import FSMSendGroup
+    from keyboards.keyboards import ReportCallback
+    from services.admin_fanout import admin_fanout
+    from services.fsm_storage import get_fsm_storage
+
+    dp = Dispatcher(storage=get_fsm_storage())
+    dp.include_router(admin_handlers.router)
+    dp.include_router(user_handlers.router)
+    data = ReportCallback(action='c', kind='m', day=ctx.today.toordinal()).pack()
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def confirm(update: Update) -> float:
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(ctx.bot, update)
+        except TelegramForbiddenError:
+            # 403 от точки при polling логирует aiogram, апдейт считается обработанным
+            ctx.failed['report_confirm'] += 1
+        except Exception as err:
+            ctx.errors[f'report_confirm: {type(err).__name__}'] += 1
+        return (time.perf_counter() - started) * 1000
+
+    timings = []
+    seconds = 0.0
+    for _ in range(ctx.repeat):
+        updates = []
+        for tg_id, name in ctx.send_list.items():
+            state = dp.fsm.get_context(ctx.bot, chat_id=int(tg_id), user_id=int(tg_id))
+            await state.set_state(FSMSendGroup.send_group)
+            await state.set_data({'media': [['photo', f'photo_{tg_id}_{num}'] for num in range(3)],
+                                  'kind': 'm', 'day': ctx.today.toordinal()})
+            updates.append(Update.model_validate(confirm_update(next(update_ids), tg_id, name, data),
+                                                 context={'bot': ctx.bot}))
+        started = time.perf_counter()
+        timings += await asyncio.gather(*[confirm(update) for update in updates])
+        seconds += time.perf_counter() - started
+    # Отчеты админам уходят в фоне и в замер не входят - дожидаемся, чтобы не мешать следующим сценариям
+    await asyncio.gather(*admin_fanout._background, return_exceptions=True)
+    await dp.storage.close()
+    return timings, len(timings), seconds
+
+
+def import_archive(size: int) -> bytes:
+    """zip-архив для импорта: manifest.csv и size картинок"""
+    import io
+    import zipfile
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        manifest = ['file,title,text'] + [f'dish_{num}.jpg,Блюдо {num},Описание блюда {num}' for num in range(size)]
+        archive.writestr('manifest.csv', '\n'.join(manifest))
+        for num in range(size):
+            archive.writestr(f'dish_{num}.jpg', b'\xff\xd8' + bytes(2048))
+    return buffer.getvalue()
+
+
+@scenario('task_import', 'блюд')
+async def bench_task_import(ctx: Context):
+    """Импорт архива из 200 блюд: параллельная загрузка медиа и один INSERT"""
+    from config_data.conf import conf
+    from services.task_import import read_document, task_importer
+
+    data = import_archive(200)
+    timings = []
+    saved = 0
+    for _ in range(ctx.repeat):
+        started = time.perf_counter()
+        result = await task_importer.run(ctx.bot, conf.tg_bot.admin_ids[0], read_document(data, 'menu.zip'))
+        timings.append((time.perf_counter() - started) * 1000)
+        saved += result.saved
+        if result.failed:
+            ctx.errors['task_import'] += len(result.failed)
+    return timings, saved, sum(timings) / 1000
+
+
+def print_compare(results: dict, baseline: dict):
+    print('\nСравнение с сохраненными итогами (throughput: больше - лучше, p50/p99: меньше - лучше):')
+    for name, summary in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        changes = []
+        for key in ('throughput', 'p50', 'p99'):
+            if base[key]:
+                changes.append(f'{key} {(summary[key] - base[key]) / base[key] * 100:+6.1f}%')
+        print(f'{name:<45} ' + '  '.join(changes))
+
+
+async def run(args):
+    db_path = setup_env()
+    send_list = seed(cafes=args.cafes, tasks=args.tasks, days=args.months * 30)
+    from database.db import async_engine
+    from benchmarks.fake_api import FakeBotAPI
+
+    forbidden = random.Random(args.seed).sample(sorted(send_list), int(len(send_list) * args.forbidden))
+    api = FakeBotAPI(latency=args.latency, rate_limit=args.rate_limit, retry_after=args.retry_after,
+                     forbidden=forbidden, seed=args.seed)
+    await api.start()
+    bot = api.bot()
+    ctx = Context(api, bot, send_list, args.repeat)
+    print(f'База {db_path}: {len(send_list)} точек, {args.tasks} задач, отчеты за {args.months} мес.; '
+          f'Bot API: задержка {args.latency} с., 429 {args.rate_limit:.0%}, 403 {len(forbidden)} точек\n')
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            func, unit = SCENARIOS[name]
+            timings, ops, seconds = await func(ctx)
+            results[name] = summarize(timings, ops, seconds)
+            print_summary(name, results[name], unit)
+    finally:
+        await bot.session.close()
+        await api.stop()
+        await async_engine.dispose()
+
+    print(f'\nВызовов Bot API: {sum(api.calls.values())}, ошибок: {dict(api.errors)}, '
+          f'апдейтов с 403: {dict(ctx.failed)}')
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding='utf-8')
+    if args.compare:
+        print_compare(results, json.loads(Path(args.compare).read_text(encoding='utf-8')))
+    if ctx.errors:
+        print(f'\nНеожиданные ошибки: {dict(ctx.errors)}')
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cafes', type=int, default=50)
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--months', type=int, default=6, help='за сколько месяцев заполнить отчеты')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS),
+                        help=f'через запятую из {", ".join(SCENARIOS)}')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа fake Bot API, с.')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='доля запросов с ответом 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответе 429, с.')
+    parser.add_argument('--forbidden', type=float, default=0.0, help='доля точек, заблокировавших бота (403)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='сохранить итоги в файл')
+    parser.add_argument('--compare', help='сравнить с итогами из файла')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(sorted(unknown))}')
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Бенчмарк проверок отчетов на истории за год.
+
+    python -m benchmarks.bench_reports --cafes 30 --days 365
+    python -m benchmarks.bench_reports --no-index   # то же без составных индексов
+"""
+import argparse
+import asyncio
+import datetime
+
+from benchmarks.common import setup_env, seed, measure
+
+
+async def run(args):
+    db_path = setup_env()
+    from sqlalchemy import select, func, text
+    from config_data.conf import tz
+    from database.db import Session, Report, engine, async_session, async_engine
+    from services.db_func import check_user, get_day_report, get_week_expire_report
+    from services.func import local_day_range
+    from services.reports import get_period_report, get_day_compliance
+
+    send_list = seed(cafes=args.cafes, days=args.days)
+    if args.no_index:
+        for index in Report.__table__.indexes:
+            index.drop(engine)
+    with Session() as session:
+        reports_count = session.query(Report).count()
+    print(f'База {db_path}: {len(send_list)} точек, {reports_count} отчетов, индексы: {not args.no_index}\n')
+
+    users = [await check_user(tg_id) for tg_id in send_list]
+    today = datetime.datetime.now(tz=tz).date()
+    yesterday = today - datetime.timedelta(days=1)
+
+    async def evening_check(legacy: bool):
+        start, end = local_day_range(today, end_hour=23)
+        async with async_session() as session:
+            for user in users:
+                if legacy:
+                    # Прежнее условие: DATE()/extract() по колонке, индекс по дате не используется
+                    period = (func.DATE(Report.date) == today, func.extract('hour', Report.date) < 23)
+                else:
+                    period = (Report.date >= start, Report.date < end)
+                q = select(Report).where(Report.user_id == user.id, Report.task_type == 'вечер', *period)
+                (await session.execute(q)).scalars().all()
+
+    async def for_all_users(func, *args):
+        for user in users:
+            await func(*args, user)
+
+    await measure('вечерняя проверка, DATE()/extract()', lambda: evening_check(legacy=True), args.repeat)
+    await measure('вечерняя проверка, интервал', lambda: evening_check(legacy=False), args.repeat)
+    await measure('get_day_compliance (все точки)', lambda: get_day_compliance(('вечер', 'бар')), args.repeat)
+    await measure('get_day_report по всем точкам',
+                  lambda: for_all_users(lambda user: get_day_report(yesterday, user, 'утро')), args.repeat)
+    await measure('get_week_expire_report по всем точкам',
+                  lambda: for_all_users(lambda user: get_week_expire_report(user.id)), args.repeat)
+    await measure('get_period_report(30)', lambda: get_period_report(30), args.repeat)
+
+    with Session() as session:
+        start, end = local_day_range(today, end_hour=23)
+        q = select(Report).where(Report.user_id == users[0].id, Report.task_type == 'вечер',
+                                 Report.date >= start, Report.date < end)
+        sql = str(q.compile(engine, compile_kwargs={'literal_binds': True}))
+        print('\nПлан запроса вечерней проверки:')
+        for row in session.execute(text(f'EXPLAIN QUERY PLAN {sql}')):
+            print('   ', row[-1])
+    await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cafes', type=int, default=30)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--no-index', action='store_true', help='удалить индексы reports перед замерами')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
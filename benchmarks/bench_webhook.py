@@ -0,0 +1,199 @@
+"""
+Бенчмарк приема апдейтов: long polling против вебхука на одной записи апдейтов.
+Бот ходит в локальный fake Bot API (benchmarks.fake_api), апдейты воспроизводятся по времени из записи:
+каждая точка нажимает "Добавить медиа", присылает альбом из photos фото и нажимает "Отправить отчет".
+
+    python -m benchmarks.bench_webhook --cafes 50
+    python -m benchmarks.bench_webhook --record updates.json   # только записать апдейты
+    python -m benchmarks.bench_webhook --updates updates.json --mode webhook
+
+Задержка апдейта - от появления апдейта в Bot API (или отправки на вебхук) до конца его обработки.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import setup_env, seed, print_timings
+
+WEBHOOK_SECRET = 'bench-secret'
+
+
+def record_updates(send_list: dict, photos: int = 3, gap: float = 1.5, spread: float = 2.0) -> list:
+    """Запись апдейтов [{'t': секунда от начала, 'kind': ..., 'update': {...}}]"""
+    records = []
+    update_ids = iter(range(1, 10 ** 9))
+    now = int(time.time())
+    for num, (tg_id, name) in enumerate(send_list.items()):
+        user = {'id': int(tg_id), 'is_bot': False, 'first_name': name, 'username': f'cafe{num}'}
+        chat = {'id': int(tg_id), 'type': 'private'}
+        task_message = {'message_id': 1000 + num, 'date': now, 'chat': chat, 'text': f'{name}\nБлюдо 1\nБлюдо 2'}
+        start = spread * num / max(len(send_list), 1)
+
+        def callback(data: str, t: float):
+            update_id = next(update_ids)
+            records.append({'t': t, 'kind': data, 'update': {'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': str(tg_id), 'data': data,
+                'message': task_message}}})
+
+        callback('start_report', start)
+        for photo in range(photos):
+            update_id = next(update_ids)
+            records.append({'t': start + gap + photo * 0.01, 'kind': 'album', 'update': {
+                'update_id': update_id, 'message': {
+                    'message_id': 2000 + update_id, 'date': now, 'chat': chat, 'from': user,
+                    'media_group_id': f'{tg_id}{num}',
+                    'photo': [{'file_id': f'photo_{update_id}', 'file_unique_id': f'u{update_id}',
+                               'width': 1280, 'height': 960}]}}})
+        callback('report_confirm', start + 2 * gap)
+    records.sort(key=lambda record: record['t'])
+    # Telegram нумерует апдейты в порядке поступления
+    for update_id, record in enumerate(records, start=1):
+        record['update']['update_id'] = update_id
+    return records
+
+
+def build_dispatcher(done: dict):
+    from aiogram import Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from handlers import user_handlers, admin_handlers
+
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(admin_handlers.router)
+    dp.include_router(user_handlers.router)
+
+    @dp.update.outer_middleware()
+    async def timing(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            done[event.update_id] = time.perf_counter()
+
+    return dp
+
+
+async def replay_polling(api, bot, dp, records: list, arrived: dict):
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False,
+                                                   polling_timeout=10))
+    await asyncio.sleep(0.2)
+    started = time.perf_counter()
+    for record in records:
+        delay = started + record['t'] - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        arrived[record['update']['update_id']] = time.perf_counter()
+        api.push_update(record['update'])
+    return polling
+
+
+async def replay_webhook(bot, dp, records: list, arrived: dict):
+    import aiohttp
+    from aiohttp import web
+    from config_data.conf import conf
+    from services.webhook import build_app
+
+    runner = web.AppRunner(build_app(bot, dp, WEBHOOK_SECRET), handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{conf.webhook.path}'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+
+    async with aiohttp.ClientSession() as session:
+        async def post(update: dict):
+            arrived[update['update_id']] = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                response.raise_for_status()
+
+        posts = []
+        started = time.perf_counter()
+        for record in records:
+            delay = started + record['t'] - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            posts.append(asyncio.create_task(post(record['update'])))
+        await asyncio.gather(*posts)
+    return runner
+
+
+async def run_mode(args):
+    setup_env()
+    send_list = seed(cafes=args.cafes, tasks=20, days=1)
+    from database.db import async_engine
+    from benchmarks.fake_api import FakeBotAPI
+
+    records = json.loads(Path(args.updates).read_text(encoding='utf-8')) if args.updates \
+        else record_updates(send_list, photos=args.photos)
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    bot = api.bot()
+    arrived, done = {}, {}
+    dp = build_dispatcher(done)
+
+    if args.mode == 'polling':
+        stopper = await replay_polling(api, bot, dp, records, arrived)
+    else:
+        stopper = await replay_webhook(bot, dp, records, arrived)
+
+    deadline = time.monotonic() + args.timeout
+    while len(done) < len(records) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    finished = max(done.values(), default=time.perf_counter())
+
+    if args.mode == 'polling':
+        await dp.stop_polling()
+        await asyncio.wait([stopper], timeout=15)
+    else:
+        await stopper.cleanup()
+    await bot.session.close()
+    await api.stop()
+    await async_engine.dispose()
+
+    print(f'\n{args.mode}: {len(done)}/{len(records)} апдейтов, '
+          f'{len(records) / (finished - min(arrived.values())):.1f} апдейтов/с, вызовов Bot API {sum(api.calls.values())}')
+    for kind in ('start_report', 'album', 'report_confirm'):
+        timings = [(done[record['update']['update_id']] - arrived[record['update']['update_id']]) * 1000
+                   for record in records
+                   if record['kind'] == kind and record['update']['update_id'] in done]
+        if timings:
+            print_timings(f'{args.mode} {kind}', timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    parser.add_argument('--cafes', type=int, default=50)
+    parser.add_argument('--photos', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа fake Bot API, с.')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--updates', help='файл с записью апдейтов')
+    parser.add_argument('--record', help='записать апдейты в файл и выйти')
+    args = parser.parse_args()
+
+    if args.record:
+        send_list = {str(7000000000 + num): f'Точка{num}' for num in range(args.cafes)}
+        Path(args.record).write_text(json.dumps(record_updates(send_list, photos=args.photos), ensure_ascii=False),
+                                     encoding='utf-8')
+        return
+    if args.mode != 'both':
+        asyncio.run(run_mode(args))
+        return
+    # Роутеры бота можно подключить только к одному диспетчеру - каждый режим в своем процессе
+    updates = args.updates
+    if not updates:
+        updates = Path(tempfile.mkdtemp(prefix='bench_')) / 'updates.json'
+        send_list = {str(7000000000 + num): f'Точка{num}' for num in range(args.cafes)}
+        updates.write_text(json.dumps(record_updates(send_list, photos=args.photos), ensure_ascii=False),
+                           encoding='utf-8')
+    for mode in ('polling', 'webhook'):
+        subprocess.run([sys.executable, '-m', 'benchmarks.bench_webhook', '--mode', mode, '--cafes', str(args.cafes),
+                        '--latency', str(args.latency), '--timeout', str(args.timeout), '--updates', str(updates)],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Общие функции бенчмарков.
+setup_env() нужно вызвать до импорта модулей бота: конфиг читается при импорте.
+"""
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_ENV = {
+    'BOT_TOKEN': '123456:bench-token',
+    'ADMIN_IDS': '100,101',
+    'TIMEZONE': 'Europe/Moscow',
+    'POSTGRES_DB': 'bench',
+    'DB_HOST': 'localhost',
+    'DB_PORT': '5432',
+    'POSTGRES_USER': 'bench',
+    'POSTGRES_PASSWORD': 'bench',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+def setup_env(db_path: Path = None) -> Path:
+    """Отдельные sqlite база и FSM для бенчмарка и фиктивные переменные окружения"""
+    for key, val in BENCH_ENV.items():
+        os.environ.setdefault(key, val)
+    if db_path is None:
+        db_path = Path(tempfile.mkdtemp(prefix='bench_')) / 'bench.sqlite3'
+    os.environ['DB_URL'] = f'sqlite:///{db_path}'
+    os.environ['FSM_DB_PATH'] = str(db_path.with_name('fsm.sqlite3'))
+    return db_path
+
+
+def use_send_list(send_list: dict):
+    """Подменяет send_list.txt временным файлом"""
+    from services import func
+    from handlers import user_handlers
+    path = Path(tempfile.mkdtemp(prefix='bench_')) / 'send_list.txt'
+    func.send_list_store = func.SendListStore(path)
+    # Хендлеры импортируют хранилище по имени
+    user_handlers.send_list_store = func.send_list_store
+    func.write_send_list_ids(send_list)
+    return path
+
+
+def seed(cafes: int = 10, tasks: int = 200, days: int = 365, fill: float = 0.9) -> dict:
+    """Заполняет базу: точки, задачи и отчеты за days дней. Возвращает список рассылки"""
+    from sqlalchemy import insert
+    from config_data.conf import tz
+    from database.db import Session, User, Task, Report
+    from services.jobs import job_book
+
+    send_list = {str(7000000000 + num): f'Точка{num}' for num in range(cafes)}
+    now = datetime.datetime.now(tz=tz)
+    with Session() as session:
+        session.execute(insert(User), [
+            {'tg_id': tg_id, 'first_name': name, 'register_date': now} for tg_id, name in send_list.items()
+        ])
+        session.execute(insert(Task), [
+            {'title': f'Блюдо {num}', 'text': 'Описание блюда', 'image': f'file_{num}', 'type': 'photo'}
+            for num in range(tasks)
+        ])
+        user_ids = [user_id for user_id, in session.query(User.id).all()]
+        rows = []
+        for day in range(days):
+            date = (now - datetime.timedelta(days=day)).replace(minute=0, second=0, microsecond=0)
+            for user_id in user_ids:
+                for task_type, (start, end) in job_book.windows.items():
+                    if random.random() < fill:
+                        hour = random.randint(start - 1, end)
+                        rows.append({'user_id': user_id, 'task_type': task_type,
+                                     'date': date.replace(hour=hour, minute=random.randint(0, 59))})
+        session.execute(insert(Report), rows)
+        session.commit()
+    use_send_list(send_list)
+    return send_list
+
+
+def percentile(values, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def print_timings(name: str, timings):
+    print(f'{name:<45} p50={percentile(timings, 50):8.2f} ms  p99={percentile(timings, 99):8.2f} ms  '
+          f'mean={statistics.mean(timings):8.2f} ms')
+
+
+def summarize(timings, ops: int, seconds: float) -> dict:
+    """Итог сценария: операций в секунду и перцентили времени в миллисекундах"""
+    return {'ops': ops, 'seconds': round(seconds, 3), 'throughput': round(ops / seconds, 2) if seconds else 0,
+            'p50': round(percentile(timings, 50), 2), 'p99': round(percentile(timings, 99), 2)}
+
+
+def print_summary(name: str, summary: dict, unit: str = 'оп'):
+    print(f'{name:<45} {summary["throughput"]:9.1f} {unit}/с  p50={summary["p50"]:8.2f} ms  '
+          f'p99={summary["p99"]:8.2f} ms  ({summary["ops"]} за {summary["seconds"]:.2f} с)')
+
+
+async def measure(name: str, func, repeat: int = 20):
+    """Запускает корутину func() repeat раз и печатает p50/p99 в миллисекундах"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        timings.append((time.perf_counter() - started) * 1000)
+    print_timings(name, timings)
+    return timings
@@ -0,0 +1,131 @@
+"""
+Локальный сервер, который отвечает как Bot API: бот бенчмарка ходит в него вместо api.telegram.org.
+getUpdates отдает апдейты из push_update() (long polling), остальные методы отвечают правдоподобным результатом.
+Ошибки Telegram: чаты из forbidden получают 403 (бот заблокирован),
+доля rate_limit остальных запросов - 429 с retry_after.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Iterable, List, Optional
+
+from aiohttp import web
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+TRUE_METHODS = {'answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'deleteMessage', 'setMyCommands'}
+# Методы без ошибок: служебные вызовы aiogram
+SAFE_METHODS = {'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook'}
+
+
+class FakeBotAPI:
+
+    def __init__(self, latency: float = 0.0, host: str = '127.0.0.1', rate_limit: float = 0.0,
+                 retry_after: int = 1, forbidden: Iterable = (), seed: Optional[int] = None):
+        self.latency = latency
+        self.host = host
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.forbidden = {str(chat_id) for chat_id in forbidden}
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._random = random.Random(seed)
+        self.updates: List[dict] = []
+        self._new_updates = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = ''
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, handle_signals=False)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{self.host}:{port}'
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def bot(self, token: str = '123456:bench-token'):
+        from aiogram import Bot
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        session = AiohttpSession(api=TelegramAPIServer.from_base(self.url))
+        return Bot(token=token, session=session, parse_mode='HTML')
+
+    def push_update(self, update: dict):
+        self.updates.append(update)
+        self._new_updates.set()
+
+    def message(self, chat_id, media: str = '') -> dict:
+        """Отправленное сообщение. media - photo или video: как после загрузки файла, с новым file_id"""
+        message_id = next(self._message_ids)
+        message = {'message_id': message_id, 'date': int(time.time()), 'text': '',
+                   'chat': {'id': int(chat_id or 0), 'type': 'private'}, 'from': BOT_USER}
+        file = {'file_id': f'fake_{media}_{message_id}', 'file_unique_id': f'u{message_id}', 'width': 1, 'height': 1}
+        if media == 'photo':
+            message['photo'] = [file]
+        elif media == 'video':
+            message['video'] = dict(file, duration=1)
+        return message
+
+    async def _get_updates(self, params) -> list:
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        while True:
+            result = [update for update in self.updates if update['update_id'] >= offset]
+            if result or time.monotonic() >= deadline:
+                # Отданное уже не нужно: следующий запрос придет с большим offset
+                self.updates = result
+                return result[:int(params.get('limit') or 100)]
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+    def _error(self, method: str, params: dict) -> Optional[web.Response]:
+        """Ответ с ошибкой Telegram или None"""
+        if method in SAFE_METHODS:
+            return None
+        if str(params.get('chat_id')) in self.forbidden:
+            self.errors[403] += 1
+            return web.json_response({'ok': False, 'error_code': 403,
+                                      'description': 'Forbidden: bot was blocked by the user'}, status=403)
+        if self.rate_limit and self._random.random() < self.rate_limit:
+            self.errors[429] += 1
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': f'Too Many Requests: retry after {self.retry_after}',
+                                      'parameters': {'retry_after': self.retry_after}}, status=429)
+        return None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(params)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        error = self._error(method, params)
+        if error is not None:
+            return error
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in TRUE_METHODS:
+            result = True
+        elif method == 'sendMediaGroup':
+            media = json.loads(params.get('media', '[]'))
+            result = [self.message(params.get('chat_id'), item.get('type', '')) for item in media]
+        elif method in ('sendPhoto', 'sendVideo'):
+            result = self.message(params.get('chat_id'), method[4:].lower())
+        else:
+            result = self.message(params.get('chat_id'))
+        return web.json_response({'ok': True, 'result': result})
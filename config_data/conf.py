@@ -1,4 +1,10 @@
+import atexit
+import copy
 import logging
+import logging.config
+import logging.handlers
+import os
+import queue
 from dataclasses import dataclass
 from typing import List
 
@@ -11,6 +17,53 @@ from structlog.typing import WrappedLogger, EventDict
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+
+class LogJump:
+    """location="файл:строка" вместо отдельных filename и lineno (или полный путь при full_path)"""
+
+    def __init__(
+        self,
+        full_path: bool = False,
+    ) -> None:
+        self.full_path = full_path
+
+    def __call__(
+        self, logger: WrappedLogger, name: str, event_dict: EventDict
+    ) -> EventDict:
+        if self.full_path:
+            file_part = "\n" + event_dict.pop("pathname")
+        else:
+            file_part = event_dict.pop("filename")
+        event_dict["location"] = f'"{file_part}:{event_dict.pop("lineno")}"'
+
+        return event_dict
+
+
+def add_exc_text(logger: WrappedLogger, method_name: str, event_dict: EventDict) -> EventDict:
+    """Текст исключения, собранный до очереди логов (LazyQueueHandler)"""
+    record = event_dict.get('_record')
+    if record is not None and record.exc_text and 'exc_info' not in event_dict:
+        event_dict['exception'] = record.exc_text
+    return event_dict
+
+
+# Обработка записей logging для форматтера JSON
+LOG_PRE_CHAIN = [
+    add_exc_text,
+    structlog.stdlib.add_log_level,
+    structlog.stdlib.add_logger_name,
+    structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S", utc=False),
+    structlog.processors.CallsiteParameterAdder(
+        [
+            # add either pathname or filename and then set full_path to True or False in LogJump below
+            # structlog.processors.CallsiteParameter.PATHNAME,
+            structlog.processors.CallsiteParameter.FILENAME,
+            structlog.processors.CallsiteParameter.LINENO,
+        ],
+    ),
+    LogJump(full_path=False),
+]
+
 LOGGING_CONFIG = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -19,6 +72,15 @@ LOGGING_CONFIG = {
         'default_formatter': {
             'format': "%(asctime)s - [%(levelname)8s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s"
         },
+        'json_formatter': {
+            '()': structlog.stdlib.ProcessorFormatter,
+            'processors': [
+                structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+                structlog.processors.format_exc_info,
+                structlog.processors.JSONRenderer(ensure_ascii=False),
+            ],
+            'foreign_pre_chain': LOG_PRE_CHAIN,
+        },
     },
 
     'handlers': {
@@ -60,12 +122,6 @@ LOGGING_CONFIG = {
 }
 
 
-def get_my_loggers():
-    import logging.config
-    logging.config.dictConfig(LOGGING_CONFIG)
-    return logging.getLogger('bot_logger'), logging.getLogger('errors_logger')
-
-
 @dataclass
 class PostgresConfig:
     database: str  # Название базы данных
@@ -73,6 +129,10 @@ class PostgresConfig:
     db_port: str  # URL-адрес базы данных
     db_user: str  # Username пользователя базы данных
     db_password: str  # Пароль к базе данных
+    pool_size: int = 5  # Постоянных соединений в пуле
+    max_overflow: int = 10  # Дополнительных соединений сверх pool_size
+    pool_timeout: int = 30  # Сколько ждать свободное соединение, с.
+    pool_recycle: int = 1800  # Пересоздавать соединения старше, с.
 
 
 @dataclass
@@ -91,9 +151,41 @@ class TgBot:
     TIMEZONE: pytz.timezone
 
 
+@dataclass
+class Webhook:
+    enabled: bool  # True - апдейты через вебхук, False - long polling
+    base_url: str  # Внешний адрес бота (https://bot.example.com). Пусто - вебхук не регистрируется ботом
+    path: str  # Путь вебхука
+    secret: str  # Секрет заголовка X-Telegram-Bot-Api-Secret-Token. Пусто - случайный, если бот сам регистрирует вебхук, иначе без проверки
+    host: str  # Адрес, на котором слушает сервер
+    port: int  # Порт сервера
+    max_concurrency: int  # Сколько апдейтов обрабатывать одновременно
+    drain_timeout: float  # Сколько ждать обработки начатых апдейтов при остановке, с.
+
+
 @dataclass
 class Logic:
-    pass
+    broadcast_workers: int  # Количество одновременных воркеров рассылки
+    broadcast_global_rate: float  # Общий лимит сообщений в секунду
+    broadcast_chat_rate: float  # Лимит сообщений в секунду в один чат
+    broadcast_chat_burst: int  # Сколько сообщений можно отправить в чат пачкой
+    delivery_mode: str  # album - задачи альбомом, single - по одной
+    task_sampling: str  # random - случайные задачи, rotation - без повторов, пока не пройдены все
+    user_cache_size: int  # Сколько пользователей держать в кэше
+    user_cache_ttl: float  # Время жизни записи кэша пользователей, с.
+    fsm_storage: str  # sqlite - черновики отчетов переживают перезапуск, db - в основной базе (несколько экземпляров, по умолчанию с вебхуком), memory - в памяти
+    fsm_db_path: Path  # Файл sqlite для FSM
+    jobs_config: Path  # Описание задач рассылки и проверок (services.jobs)
+    leader_backend: str  # db - лидер выбирается через таблицу leases, local - единственный экземпляр всегда лидер
+    leader_ttl: float  # Срок аренды лидерства, с. За это время после падения лидера его место займет другой
+    leader_heartbeat: float  # Как часто лидер продлевает аренду, а остальные пытаются ее занять, с.
+    log_format: str  # text - читаемые логи, json - JSON (для сбора логов в проде)
+    log_level: str  # Уровень логов бота
+    log_levels: dict  # Уровни отдельных модулей {'services.broadcast': 'INFO'}
+    metrics_enabled: bool  # Сбор метрик и сервер /metrics (services.metrics)
+    metrics_host: str  # Адрес сервера метрик
+    metrics_port: int  # Порт сервера метрик
+    import_concurrency: int  # Сколько альбомов загружать одновременно при импорте задач (services.task_import)
 
 
 @dataclass
@@ -101,6 +193,7 @@ class Config:
     tg_bot: TgBot
     db: PostgresConfig
     logic: Logic
+    webhook: Webhook
 
 
 def load_config(path) -> Config:
@@ -117,8 +210,44 @@ def load_config(path) -> Config:
                       db_port=env('DB_PORT'),
                       db_user=env('POSTGRES_USER'),
                       db_password=env('POSTGRES_PASSWORD'),
+                      pool_size=env.int('DB_POOL_SIZE', 5),
+                      max_overflow=env.int('DB_MAX_OVERFLOW', 10),
+                      pool_timeout=env.int('DB_POOL_TIMEOUT', 30),
+                      pool_recycle=env.int('DB_POOL_RECYCLE', 1800),
                       ),
                   logic=Logic(
+                      broadcast_workers=env.int('BROADCAST_WORKERS', 16),
+                      broadcast_global_rate=env.float('BROADCAST_GLOBAL_RATE', 25),
+                      broadcast_chat_rate=env.float('BROADCAST_CHAT_RATE', 1),
+                      broadcast_chat_burst=env.int('BROADCAST_CHAT_BURST', 5),
+                      delivery_mode=env('DELIVERY_MODE', 'album'),
+                      task_sampling=env('TASK_SAMPLING', 'rotation'),
+                      user_cache_size=env.int('USER_CACHE_SIZE', 1024),
+                      user_cache_ttl=env.float('USER_CACHE_TTL', 600),
+                      # Вебхук - это обычно несколько экземпляров: по умолчанию общее хранилище в базе
+                      fsm_storage=env('FSM_STORAGE', 'db' if env.bool('WEBHOOK', False) else 'sqlite'),
+                      fsm_db_path=env.path('FSM_DB_PATH', BASE_DIR / 'fsm.sqlite3'),
+                      jobs_config=env.path('JOBS_CONFIG', BASE_DIR / 'config_data' / 'jobs.json'),
+                      leader_backend=env('LEADER_BACKEND', 'db'),
+                      leader_ttl=env.float('LEADER_TTL', 10),
+                      leader_heartbeat=env.float('LEADER_HEARTBEAT', 3),
+                      log_format=env('LOG_FORMAT', 'text'),
+                      log_level=env('LOG_LEVEL', 'DEBUG'),
+                      log_levels=env.dict('LOG_LEVELS', {}),
+                      metrics_enabled=env.bool('METRICS', False),
+                      metrics_host=env('METRICS_HOST', '127.0.0.1'),
+                      metrics_port=env.int('METRICS_PORT', 9101),
+                      import_concurrency=env.int('IMPORT_CONCURRENCY', 4),
+                  ),
+                  webhook=Webhook(
+                      enabled=env.bool('WEBHOOK', False),
+                      base_url=env('WEBHOOK_URL', ''),
+                      path=env('WEBHOOK_PATH', '/webhook'),
+                      secret=env('WEBHOOK_SECRET', ''),
+                      host=env('WEBHOOK_HOST', '0.0.0.0'),
+                      port=env.int('WEBHOOK_PORT', 8080),
+                      max_concurrency=env.int('WEBHOOK_CONCURRENCY', 64),
+                      drain_timeout=env.float('WEBHOOK_DRAIN_TIMEOUT', 30),
                   ),
 
                   )
@@ -126,52 +255,82 @@ def load_config(path) -> Config:
 
 conf = load_config('.env')
 #conf.db.db_url = f"postgresql+psycopg2://{conf.db.db_user}:{conf.db.db_password}@{conf.db.db_host}:{conf.db.db_port}/{conf.db.database}"
-conf.db.db_url = f"sqlite:///base.sqlite"
+conf.db.db_url = os.getenv('DB_URL', f"sqlite:///base.sqlite")
+#conf.db.async_db_url = f"postgresql+asyncpg://{conf.db.db_user}:{conf.db.db_password}@{conf.db.db_host}:{conf.db.db_port}/{conf.db.database}"
+conf.db.async_db_url = os.getenv('ASYNC_DB_URL', conf.db.db_url.replace(
+    'sqlite://', 'sqlite+aiosqlite://').replace('postgresql+psycopg2://', 'postgresql+asyncpg://'))
 tz = conf.tg_bot.TIMEZONE
 
 
-def get_my_loggers():
-    class LogJump:
-        def __init__(
-            self,
-            full_path: bool = False,
-        ) -> None:
-            self.full_path = full_path
-
-        def __call__(
-            self, logger: WrappedLogger, name: str, event_dict: EventDict
-        ) -> EventDict:
-            if self.full_path:
-                file_part = "\n" + event_dict.pop("pathname")
-            else:
-                file_part = event_dict.pop("filename")
-            event_dict["location"] = f'"{file_part}:{event_dict.pop("lineno")}"'
-
-            return event_dict
-    path = BASE_DIR / 'logs' / 'bot.log'
-    structlog.configure(
-        processors=[
-            structlog.contextvars.merge_contextvars,
-            structlog.processors.add_log_level,
-            structlog.processors.StackInfoRenderer(),
-            structlog.dev.set_exc_info,
-            structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S", utc=False),
-            structlog.processors.CallsiteParameterAdder(
-                [
-                    # add either pathname or filename and then set full_path to True or False in LogJump below
-                    # structlog.processors.CallsiteParameter.PATHNAME,
-                    structlog.processors.CallsiteParameter.FILENAME,
-                    structlog.processors.CallsiteParameter.LINENO,
-                ],
-            ),
-            LogJump(full_path=False),
-            structlog.dev.ConsoleRenderer(),
-        ],
-        wrapper_class=structlog.make_filtering_bound_logger(logging.DEBUG),
-        context_class=dict,
-        logger_factory=structlog.PrintLoggerFactory(),
-        # logger_factory=structlog.WriteLoggerFactory(file=path.open("wt", encoding='utf-8')),
-        cache_logger_on_first_use=False,
-    )
-    logger = structlog.stdlib.get_logger()
-    return logger, logger
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет запись в очередь с уже собранным сообщением (msg % args) и текстом исключения:
+    изменяемые args и traceback не уходят в другой поток. Форматирование записи обработчиками
+    (время, уровень, JSON) и запись в файлы выполняются в потоке QueueListener.
+    Сообщение собирается только для записей, прошедших по уровню
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_exc_formatter = logging.Formatter()
+
+
+_listeners: List[logging.handlers.QueueListener] = []
+
+
+def stop_logging():
+    """Дописывает записи из очередей и останавливает потоки логирования"""
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def setup_logging():
+    """
+    Настраивает логирование по LOGGING_CONFIG один раз за процесс.
+    Обработчики bot_logger и errors_logger (файлы, консоль) работают в фоновых потоках QueueListener,
+    логгеры только кладут записи в очередь. LOG_FORMAT=json - все обработчики пишут JSON.
+    Уровень - LOG_LEVEL, уровни отдельных модулей - LOG_LEVELS (services.broadcast=INFO,handlers=WARNING)
+    """
+    if _listeners:
+        return
+    (BASE_DIR / 'logs').mkdir(exist_ok=True)
+    config = LOGGING_CONFIG
+    if conf.logic.log_format == 'json':
+        config = {**LOGGING_CONFIG, 'handlers': {
+            name: {**handler, 'formatter': 'json_formatter'} for name, handler in LOGGING_CONFIG['handlers'].items()
+        }}
+    logging.config.dictConfig(config)
+    for name in ('bot_logger', 'errors_logger'):
+        named_logger = logging.getLogger(name)
+        handlers = list(named_logger.handlers)
+        for handler in handlers:
+            named_logger.removeHandler(handler)
+        log_queue = queue.SimpleQueue()
+        named_logger.addHandler(LazyQueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _listeners.append(listener)
+    logging.getLogger('bot_logger').setLevel(conf.logic.log_level.upper())
+    for module, level in conf.logic.log_levels.items():
+        logging.getLogger(f'bot_logger.{module}').setLevel(level.upper())
+    atexit.register(stop_logging)
+
+
+def get_my_loggers(name: str = None):
+    """
+    (логгер модуля, логгер ошибок). В модулях: logger, err_log = get_my_loggers(__name__) -
+    тогда уровень модуля можно задать в LOG_LEVELS.
+    Сообщения лучше передавать с аргументами: logger.debug('Задачи %s', tasks) -
+    при выключенном DEBUG строка не собирается
+    """
+    setup_logging()
+    bot_logger = logging.getLogger(f'bot_logger.{name}' if name else 'bot_logger')
+    return bot_logger, logging.getLogger('errors_logger')
@@ -5,16 +5,19 @@ from time import time
 from typing import Sequence, List
 
 from sqlalchemy import create_engine, ForeignKey, Date, String, DateTime, \
-    Float, UniqueConstraint, Integer, MetaData, BigInteger, ARRAY, Table, Column, select, JSON
+    Float, UniqueConstraint, Integer, MetaData, BigInteger, ARRAY, Table, Column, select, JSON, Index, update, event, Text
 from sqlalchemy.dialects.mysql import TEXT
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, relationship
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from config_data.conf import conf, tz, get_my_loggers, BASE_DIR
+from services.user_cache import user_cache
 
-logger, err_log = get_my_loggers()
+logger, err_log = get_my_loggers(__name__)
 metadata = MetaData()
 # db_url = f"postgresql+psycopg2://{conf.db.db_user}:{conf.db.db_password}@{conf.db.db_host}:{conf.db.db_port}/{conf.db.database}"
 # engine = create_engine(db_url, echo=False, max_overflow=-1)
@@ -26,6 +29,40 @@ engine = create_engine(conf.db.db_url, echo=False)
 Session = sessionmaker(bind=engine)
 
 
+def engine_options(db_url: str) -> dict:
+    """Настройки пула соединений асинхронного движка"""
+    if db_url.startswith('sqlite') and ':memory:' in db_url:
+        return {}
+    options = dict(pool_size=conf.db.pool_size, max_overflow=conf.db.max_overflow,
+                   pool_timeout=conf.db.pool_timeout, pool_recycle=conf.db.pool_recycle)
+    if db_url.startswith('sqlite'):
+        # Для aiosqlite по умолчанию NullPool - соединение открывалось бы на каждую сессию
+        options['poolclass'] = AsyncAdaptedQueuePool
+        options['connect_args'] = {'timeout': conf.db.pool_timeout}
+    else:
+        options['pool_pre_ping'] = True
+    return options
+
+
+# Асинхронный движок: aiosqlite для sqlite, asyncpg для postgres. Хендлеры и задачи работают через него
+async_engine = create_async_engine(conf.db.async_db_url, echo=False, **engine_options(conf.db.async_db_url))
+async_session = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """WAL: чтение не блокируется записью"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+if conf.db.db_url.startswith('sqlite'):
+    event.listen(engine, 'connect', set_sqlite_pragma)
+if conf.db.async_db_url.startswith('sqlite'):
+    event.listen(async_engine.sync_engine, 'connect', set_sqlite_pragma)
+
+
 class Base(DeclarativeBase):
     pass
 
@@ -42,21 +79,21 @@ class User(Base):
     full_name: Mapped[str] = mapped_column(String(200), nullable=True)
     register_date: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
     referral: Mapped[str] = mapped_column(String(20), nullable=True)
-    reports: Mapped[List['Report']] = relationship(back_populates='user', lazy='selectin')
+    reports: Mapped[List['Report']] = relationship(back_populates='user', lazy='select')
 
     def __repr__(self):
         return f'{self.id}. {self.tg_id} {self.username or "-"}'
 
-    def set(self, key, value):
-        _session = Session()
+    async def set(self, key, value):
         try:
-            with _session:
-                order = _session.query(User).filter(User.id == self.id).one_or_none()
-                setattr(order, key, value)
-                _session.commit()
-                logger.debug(f'Изменено значение {key} на {value}')
+            async with async_session() as session:
+                await session.execute(update(User).where(User.id == self.id).values({key: value}))
+                await session.commit()
+                setattr(self, key, value)
+                user_cache.put(self)
+                logger.debug('Изменено значение %s на %s', key, value)
         except Exception as err:
-            err_log.error(f'Ошибка изменения {key} на {value}')
+            err_log.error('Ошибка изменения %s на %s', key, value)
             raise err
 
 
@@ -74,33 +111,33 @@ class Task(Base):
         return f'{self.id}: {self.text[:20]}'
 
     @classmethod
-    def get_items(cls):
-        session = Session()
-        with session:
+    async def get_items(cls):
+        async with async_session() as session:
             items_q = select(cls)
-            items = session.execute(items_q).scalars().all()
+            items = (await session.execute(items_q)).scalars().all()
             return items
 
     @classmethod
-    def get_item(cls, num):
-        session = Session()
-        with session:
+    async def get_item(cls, num):
+        async with async_session() as session:
             item = select(cls).where(cls.id == num)
-            item = session.execute(item).scalar()
+            item = (await session.execute(item)).scalar()
             return item
 
-    def get_nav_btn(self, num):
+    async def get_nav_btn(self, num):
+        # services.task_catalog сам импортирует этот модуль
+        from services.task_catalog import task_catalog
         nav_btn = {
             '<<': 'back',
-            f'{num + 1}/{len(self.get_items())}': '-',
+            f'{num + 1}/{await task_catalog.count()}': '-',
             '>>': 'fwd',
         }
         return nav_btn
 
     @classmethod
-    def get_title_menu(cls):
+    async def get_title_menu(cls):
         menus = []
-        for item in cls.get_items():
+        for item in await cls.get_items():
             if item.title:
                 menus.append([item.title, item.id])
         return menus
@@ -116,7 +153,94 @@ class Report(Base):
     date: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
     task_type:  Mapped[str] = mapped_column(String(20), default='утро')
 
+    __table_args__ = (
+        Index('ix_reports_user_type_date', 'user_id', 'task_type', 'date'),
+        Index('ix_reports_type_date', 'task_type', 'date'),
+    )
+
     def __repr__(self):
         return f'Report {self.id}. {self.user} {self.date}'
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+
+class OutboxMessage(Base):
+    """Исходящее сообщение точке: список вызовов Bot API, выполняемых по порядку"""
+    __tablename__ = 'outbox'
+    id: Mapped[int] = mapped_column(primary_key=True,
+                                    autoincrement=True,
+                                    comment='Первичный ключ')
+    idempotency_key: Mapped[str] = mapped_column(String(200), unique=True)
+    job: Mapped[str] = mapped_column(String(50))
+    chat_id: Mapped[str] = mapped_column(String(30))
+    calls: Mapped[list] = mapped_column(JSON)
+    step: Mapped[int] = mapped_column(Integer, default=0, comment='Сколько вызовов уже выполнено')
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    status: Mapped[str] = mapped_column(String(20), default='pending')
+    next_attempt_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    created: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    last_error: Mapped[str] = mapped_column(String(1000), nullable=True)
+
+    __table_args__ = (
+        Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    def __repr__(self):
+        return f'Outbox {self.id}. {self.idempotency_key} {self.status}'
+
+
+class DeadLetter(Base):
+    """Сообщения, которые не удалось доставить"""
+    __tablename__ = 'outbox_dead'
+    id: Mapped[int] = mapped_column(primary_key=True,
+                                    autoincrement=True,
+                                    comment='Первичный ключ')
+    idempotency_key: Mapped[str] = mapped_column(String(200))
+    job: Mapped[str] = mapped_column(String(50))
+    chat_id: Mapped[str] = mapped_column(String(30))
+    calls: Mapped[list] = mapped_column(JSON)
+    step: Mapped[int] = mapped_column(Integer, default=0)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[str] = mapped_column(String(1000), nullable=True)
+    created: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return f'DeadLetter {self.id}. {self.idempotency_key}'
+
+
+class JobRun(Base):
+    """Последний запуск задачи планировщика - для догоняющего запуска после простоя"""
+    __tablename__ = 'job_runs'
+    name: Mapped[str] = mapped_column(String(100), primary_key=True)
+    last_fire: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), comment='Плановое время запуска')
+    started: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f'JobRun {self.name} {self.last_fire}'
+
+
+class FSMRecord(Base):
+    """Состояние FSM пользователя для FSM_STORAGE=db: общее для всех экземпляров бота"""
+    __tablename__ = 'fsm_states'
+    key: Mapped[str] = mapped_column(String(200), primary_key=True)
+    state: Mapped[str] = mapped_column(String(200), nullable=True)
+    data: Mapped[str] = mapped_column(Text, default='{}')
+
+    def __repr__(self):
+        return f'FSMRecord {self.key} {self.state}'
+
+
+class Lease(Base):
+    """Аренда роли (например, лидера планировщика) экземпляром бота. Время - UTC"""
+    __tablename__ = 'leases'
+    name: Mapped[str] = mapped_column(String(100), primary_key=True)
+    holder: Mapped[str] = mapped_column(String(200))
+    expires_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return f'Lease {self.name} {self.holder} до {self.expires_at}'
+
+
+Base.metadata.create_all(engine)
+# create_all не добавляет индексы в уже существующие таблицы
+for index in Report.__table__.indexes:
+    index.create(engine, checkfirst=True)
@@ -1,5 +1,6 @@
 import datetime
 import json
+from typing import Tuple
 
 from aiogram import Router, Bot, F
 from aiogram.enums import ContentType
@@ -7,20 +8,27 @@ from aiogram.filters import Command, BaseFilter
 from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import CallbackQuery, Message, ChatInviteLink, \
-    InlineKeyboardButton, ChatMemberUpdated, FSInputFile, InputMediaPhoto, InputMediaDocument
+    InlineKeyboardButton, ChatMemberUpdated, FSInputFile, InputMediaPhoto, InputMediaDocument, InlineKeyboardMarkup
 
 from aiogram.fsm.context import FSMContext
 
 
-from config_data.conf import get_my_loggers, BASE_DIR, conf
+from config_data.conf import get_my_loggers, BASE_DIR, conf, tz
 from database.db import Task
-from keyboards.keyboards import yes_no_kb, start_kb, custom_kb, start_bn, nav_kb, confirm_kb
+from keyboards.keyboards import yes_no_kb, start_kb, custom_kb, start_bn, nav_kb, confirm_kb, page_kb
 from lexicon.lexicon import LEXICON_RU
 
-from services.db_func import get_or_create_user, task_db_save, task_db_delete, get_last_days_report, check_user
+from services.album import album_collector
+from services.db_func import get_or_create_user, task_db_save, task_db_delete, task_db_save_many
 from services.func import write_send_list_ids, read_send_list_ids
+from services.jobs import job_book, job_dispatcher
+from services.outbox import outbox
+from services.reports import get_period_report
+from services.task_catalog import task_catalog
+from services.task_import import task_importer, read_document, items_from_messages, failure, Progress, \
+    TaskImportError
 
-logger, err_log = get_my_loggers()
+logger, err_log = get_my_loggers(__name__)
 
 
 class IsAdmin(BaseFilter):
@@ -52,8 +60,12 @@ class FSMSendList(StatesGroup):
     list_edit = State()
 
 
+class FSMTaskImport(StatesGroup):
+    import_wait = State()
+
+
 @router.callback_query(F.data == 'cancel')
-async def stat(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def cancel(callback: CallbackQuery, state: FSMContext, bot: Bot):
     await callback.message.delete()
     await state.clear()
     await callback.message.answer('Бот приветствует вас!', reply_markup=start_kb)
@@ -61,16 +73,16 @@ async def stat(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 @router.message(Command(commands=["start"]))
 async def process_start_command(message: Message, state: FSMContext, bot: Bot):
-    logger.debug(f'/start {message.from_user.id}')
+    logger.debug('/start %s', message.from_user.id)
     await state.clear()
     referal = message.text[7:]
-    new_user = get_or_create_user(message.from_user, referal)
+    new_user = await get_or_create_user(message.from_user, referal)
     await message.answer('Бот приветствует вас!', reply_markup=start_kb)
 
 
 # Добавление блюда-задачи
 @router.callback_query(F.data == 'add_task')
-async def echo(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def add_task(callback: CallbackQuery, state: FSMContext, bot: Bot):
     await callback.message.delete()
     await callback.message.answer('Пришлите изображение или видео')
     await state.set_state(FSMTask.send_photo)
@@ -127,50 +139,134 @@ async def save_title(message: Message, state: FSMContext, bot: Bot):
 async def save_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot):
     if callback.data == 'confirm':
         data = await state.get_data()
-        print(data)
+        logger.debug('Сохранение задачи: %s', data)
         text = data.get('text')
         title = data.get('title')
         file_id = data.get('file_id')
         content_type = data.get('content_type')
         await callback.message.edit_reply_markup(reply_markup=None)
-        task_id = task_db_save(title, text, file_id, content_type)
+        task_id = await task_db_save(title, text, file_id, content_type)
         await callback.message.answer(f'Сохранено #{task_id}', reply_markup=start_kb)
         await state.clear()
 
 
+# Массовый импорт блюд
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024  # Лимит Bot API на скачивание файла
+IMPORT_HELP = (
+    'Пришлите zip-архив с manifest.csv (колонки file,title,text) или manifest.json и файлами фото/видео, '
+    'либо сам манифест, где file - ссылка или file_id.\n'
+    'Можно переслать альбомы или фото/видео с подписями: первая строка подписи - название, остальное - текст. '
+    'Присланные медиа сохраняются кнопкой "Сохранить".'
+)
+import_kb = custom_kb(2, {'Отмена': 'cancel', 'Сохранить': 'import_save'})
+
+
+@router.callback_query(F.data == 'task_import')
+async def task_import(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    await callback.message.delete()
+    await state.set_data({'rows': [], 'failed': []})
+    await callback.message.answer(IMPORT_HELP, reply_markup=custom_kb(1, {'Отмена': 'cancel'}))
+    await state.set_state(FSMTaskImport.import_wait)
+
+
+@router.message(FSMTaskImport.import_wait, F.document)
+async def import_document(message: Message, state: FSMContext, bot: Bot):
+    document = message.document
+    if document.file_size and document.file_size > MAX_DOWNLOAD_SIZE:
+        await message.answer('Файл больше 20 МБ - разбейте архив на части')
+        return
+    status = await message.answer('Чтение файла...')
+    try:
+        data = await bot.download(document)
+        items = read_document(data.read(), document.file_name or '')
+    except TaskImportError as err:
+        await status.edit_text(str(err))
+        return
+    await status.edit_text(f'Загрузка медиа: 0/{len(items)}')
+    result = await task_importer.run(bot, message.chat.id, items, Progress(status))
+    await message.answer(result.text, reply_markup=custom_kb(1, {'Готово': 'cancel'}))
+
+
+@router.message(FSMTaskImport.import_wait)
+async def import_media(message: Message, state: FSMContext, bot: Bot):
+    # Альбом приходит отдельными сообщениями - принимаем его целиком один раз
+    messages = await album_collector.collect(message)
+    if not messages:
+        return
+    data = await state.get_data()
+    rows, failed = data.setdefault('rows', []), data.setdefault('failed', [])
+    for item in items_from_messages(messages):
+        if item.error:
+            failed.append(failure(item))
+        else:
+            rows.append(item.row())
+    await state.set_data(data)
+    text = f'Принято блюд: {len(rows)}'
+    if failed:
+        text += f', без подписи или не фото/видео: {len(failed)}'
+    await message.answer(text, reply_markup=import_kb)
+
+
+@router.callback_query(FSMTaskImport.import_wait, F.data == 'import_save')
+async def import_save(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    data = await state.get_data()
+    await callback.message.edit_reply_markup(reply_markup=None)
+    saved = await task_db_save_many(data.get('rows', []))
+    await state.clear()
+    await callback.message.answer(f'Добавлено блюд: {saved}', reply_markup=start_kb)
+
+
 # Список блюд
-def format_task_list() -> str:
-    tasks = Task.get_items()
-    if not tasks:
-        return ''
-    text = 'Список:\n'
-    for task in tasks:
-        text += f'<b>{task.id}. {task.title}</b>\n\n'
-    return text[:3999]
+TASK_PAGE_PREFIX = 'task_page_'
+
+
+async def format_task_page(after_id: int = 0, delete_mode: bool = False) -> Tuple[str, InlineKeyboardMarkup]:
+    """Страница списка задач с id больше after_id и кнопки листания"""
+    page = await task_catalog.page(after_id)
+    if not page.items and after_id:
+        # Задачи страницы удалены - начинаем сначала
+        page = await task_catalog.page()
+    if not page.items:
+        return 'Список пуст', start_kb
+    text = f'Список ({page.start + 1}-{page.start + len(page.items)} из {page.total}):\n'
+    for task_id, title in page.items:
+        text += f'<b>{task_id}. {title}</b>\n\n'
+    if delete_mode:
+        text += 'Введите номер для удаления'
+    return text, page_kb(TASK_PAGE_PREFIX, page.prev_after, page.next_after, f'{page.number}/{page.pages}',
+                         back='Меню')
 
 
 @router.callback_query(F.data == 'task_list')
-async def echo(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    await callback.message.edit_text(text=format_task_list(), reply_markup=start_kb)
+async def task_list(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    text, keyboard = await format_task_page()
+    await callback.message.edit_text(text=text, reply_markup=keyboard)
 
 
 @router.callback_query(F.data == 'task_del')
-async def echo(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    await callback.message.edit_reply_markup(reply_markup=None)
-    text = f'{format_task_list()}Введите номер для удаления'
-    if not text:
-        await callback.message.edit_text('Список пуст')
+async def task_del(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    if not await task_catalog.count():
+        await callback.message.edit_text('Список пуст', reply_markup=start_kb)
         return
-    await callback.message.edit_text(text)
+    text, keyboard = await format_task_page(delete_mode=True)
+    await callback.message.edit_text(text, reply_markup=keyboard)
     await state.set_state(FSMTask.task_delete)
 
 
+@router.callback_query(F.data.startswith(TASK_PAGE_PREFIX))
+async def task_page(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    after_id = int(callback.data.split(TASK_PAGE_PREFIX)[1])
+    delete_mode = await state.get_state() == FSMTask.task_delete.state
+    text, keyboard = await format_task_page(after_id, delete_mode)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
 @router.message(FSMTask.task_delete)
 async def task_delete(message: Message, state: FSMContext, bot: Bot):
     try:
         task_id = int(message.text.strip())
         await state.update_data(task_id=task_id)
-        task: Task = Task().get_item(task_id)
+        task: Task = await Task.get_item(task_id)
         if not task:
             await message.answer('Такого номера нет. Введите номер для удаления')
         else:
@@ -190,7 +286,7 @@ async def task_delete_confirm(callback: CallbackQuery,  state: FSMContext, bot:
     await callback.message.delete()
     data = await state.get_data()
     task_id = data.get('task_id')
-    result = task_db_delete(task_id)
+    result = await task_db_delete(task_id)
     await state.clear()
     if result:
         await callback.message.answer('Удалено', reply_markup=start_kb)
@@ -212,7 +308,7 @@ async def send_list_edit(callback: CallbackQuery,  state: FSMContext, bot: Bot):
             )
     msg = await callback.message.answer(text, reply_markup=custom_kb(1, {'Отменить редактирование': 'cancel'}))
     await state.set_state(FSMSendList.list_edit)
-    await state.update_data(msg=msg)
+    await state.update_data(msg_id=msg.message_id)
 
 
 @router.message(FSMSendList.list_edit)
@@ -220,40 +316,72 @@ async def list_edit(message: Message, state: FSMContext, bot: Bot):
     try:
         new_send_dict = {}
         rows = message.text.strip().split('\n')
-        print(rows)
         for row in rows:
             tg_id, name = row.split()
             new_send_dict[tg_id.strip()] = name.strip()
-        print(new_send_dict)
+        logger.debug('Новый список рассылки: %s', new_send_dict)
         write_send_list_ids(new_send_dict)
         await message.answer(f'Новый список: {new_send_dict}')
         data = await state.get_data()
-        msg = data.get('msg')
-        await bot.delete_message(chat_id=message.chat.id, message_id=msg.message_id)
+        await bot.delete_message(chat_id=message.chat.id, message_id=data.get('msg_id'))
     except Exception as err:
         await message.answer(f'Ошибка: {err}', reply_markup=start_kb)
         await state.clear()
 
 
-def format_report_text(report_data: dict):
+def format_report_text(report_data: dict, users: dict):
     text = f''
     for tg_id, day_false in report_data.items():
-        user = check_user(tg_id)
+        user = users.get(tg_id)
         if user:
             text += f'{user.first_name} ({user.tg_id}): <b>{day_false}</b>\n'
     return text
 
 
 @router.callback_query(F.data.startswith('send_report_'))
-async def send_list_edit(callback: CallbackQuery,  state: FSMContext, bot: Bot):
+async def send_report(callback: CallbackQuery,  state: FSMContext, bot: Bot):
     # await callback.message.delete()
     days = int(callback.data.split('send_report_')[1])
-    today = (datetime.datetime.today() - datetime.timedelta(days=1)).date()
+    period_report = await get_period_report(days_ago=days)
 
     for report_type in ['утро', 'вечер', 'бар']:
-        report_data = get_last_days_report(report_type=report_type, days_ago=days)
-        text = f'<b>Отчет "{report_type}" за период {(today - datetime.timedelta(days=days - 1))} - {today}</b>\n'
-        text = text + format_report_text(report_data)
+        text = f'<b>Отчет "{report_type}" за период {period_report.start} - {period_report.end}</b>\n'
+        text = text + format_report_text(period_report.missed(report_type), period_report.users)
         await callback.message.answer(text)
 
 
+# План рассылки
+async def format_broadcast_plan() -> str:
+    plan_jobs = [name for name, job in job_book.jobs.items() if job.plan]
+    messages = await outbox.scheduled(plan_jobs)
+    if not messages:
+        return 'Плана рассылки нет'
+    send_list = read_send_list_ids()
+    text = ''
+    header = None
+    for message in messages:
+        send_at = message.next_attempt_at
+        if send_at.tzinfo:
+            send_at = send_at.astimezone(tz)
+        if (message.job, send_at) != header:
+            header = (message.job, send_at)
+            day = outbox.key_day(message.idempotency_key)
+            text += f'\n<b>{message.job} за {day:%d.%m}, отправка {send_at:%d.%m %H:%M}</b>\n'
+        # Последний вызов - сообщение со списком задач точки
+        lines = message.calls[-1]['params']['text'].strip().split('\n')
+        text += f'{send_list.get(message.chat_id, lines[0])}: {", ".join(lines[1:])}\n'
+    return text[:3999]
+
+
+@router.callback_query(F.data == 'broadcast_plan')
+async def broadcast_plan(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    await callback.message.answer(await format_broadcast_plan(),
+                                  reply_markup=custom_kb(2, {'Пересобрать': 'broadcast_replan', 'Закрыть': 'cancel'}))
+
+
+@router.callback_query(F.data == 'broadcast_replan')
+async def broadcast_replan(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    await callback.message.edit_reply_markup(reply_markup=None)
+    planned = await job_dispatcher.replan()
+    await callback.message.answer(f'План пересобран, сообщений: {planned}\n{await format_broadcast_plan()}'[:3999],
+                                  reply_markup=start_kb)
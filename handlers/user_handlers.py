@@ -1,18 +1,26 @@
 import asyncio
+import datetime
+from contextlib import suppress
+from typing import Optional
 
 from aiogram import Router, Bot, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.media_group import MediaGroupBuilder
 
-from config_data.conf import get_my_loggers, conf
-from keyboards.keyboards import custom_kb, report_kb
-from services.db_func import get_or_create_user, save_report, save_evening_report
-from services.func import read_send_list_ids
+from config_data.conf import get_my_loggers, conf, tz
+from keyboards.keyboards import custom_kb, ReportCallback, REPORT_ACTIONS, REPORT_KIND_CODES, REPORT_KINDS, \
+    legacy_report_type, report_keyboard
+from services.admin_fanout import admin_fanout
+from services.album import album_collector
+from services.broadcast import broadcaster
+from services.db_func import get_or_create_user, save_report
+from services.func import send_list_store
 
-logger, err_log = get_my_loggers()
+logger, err_log = get_my_loggers(__name__)
 
 router: Router = Router()
 
@@ -23,21 +31,38 @@ class FSMSendGroup(StatesGroup):
 
 @router.message(Command(commands=["start"]))
 async def process_start_command(message: Message, state: FSMContext, bot: Bot):
-    logger.debug(f'/start {message.from_user.id}')
-    user = get_or_create_user(message.from_user)
+    logger.debug('/start %s', message.from_user.id)
+    user = await get_or_create_user(message.from_user)
     await state.clear()
     await message.answer('Бот приветствует вас!')
 
 
+def build_media_group(media: list) -> MediaGroupBuilder:
+    """MediaGroupBuilder из сохраненного в состоянии списка [тип, file_id]"""
+    media_group = MediaGroupBuilder()
+    for media_type, file_id in media:
+        media_group.add(type=media_type, media=file_id)
+    return media_group
+
+
+def report_callback_data(callback: CallbackQuery, callback_data: Optional[ReportCallback]) -> ReportCallback:
+    """Данные кнопки отчета. У заданий, разосланных до ReportCallback, тип определяется по тексту"""
+    if callback_data is not None:
+        return callback_data
+    report_type = legacy_report_type(callback.message.text or '')
+    return ReportCallback(action=REPORT_ACTIONS[callback.data], kind=REPORT_KIND_CODES[report_type],
+                          day=callback.message.date.astimezone(tz).date().toordinal())
+
+
+@router.callback_query(ReportCallback.filter(F.action == 's'))
 @router.callback_query(F.data == 'start_report')
-async def start_report(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def start_report(callback: CallbackQuery, state: FSMContext, bot: Bot,
+                       callback_data: Optional[ReportCallback] = None):
     """Начало ответа на задание"""
+    callback_data = report_callback_data(callback, callback_data)
     await callback.answer('Вход в режим ответа')
-    # caption = f'Отчет от {callback.from_user.id} {callback.from_user.username}\n'
-    # caption += callback.message.caption
-    media_group = MediaGroupBuilder()
-    msg = callback.message
-    await state.update_data(media_group=media_group, msg=msg)
+    await state.set_data({'media': [], 'kind': callback_data.kind, 'day': callback_data.day,
+                          'msg_id': callback.message.message_id})
     await callback.message.answer('Отправьте сжатое фото или видео для отчета (или несколько)')
     await state.set_state(FSMSendGroup.send_group)
 
@@ -46,21 +71,28 @@ async def start_report(callback: CallbackQuery, state: FSMContext, bot: Bot):
 async def media_receiver(message: Message, state: FSMContext, bot: Bot):
     """Прием отправленных медиа для задания"""
     try:
+        # Альбом приходит отдельными сообщениями - обрабатываем его целиком один раз
+        messages = await album_collector.collect(message)
+        if not messages:
+            return
         data = await state.get_data()
-        media_group: MediaGroupBuilder = data.get('media_group')
-        if message.photo:
-            media_group.add_photo(media=message.photo[-1].file_id)
-        await state.update_data(media_group=media_group)
-        data = await state.get_data()
-        if message.video:
-            media_group.add_video(media=message.video.file_id)
-        if message.document:
-            media_group.add_document(media=message.document.file_id)
-        msg: Message = data.get('msg')
-        text = f'{msg.text or ""}' + f'\n\nДобавлено {len(media_group.build())} медиафайлов'
-        await bot.edit_message_text(text=text, chat_id=message.chat.id, message_id=msg.message_id, reply_markup=report_kb)
-        await asyncio.sleep(0.2)
-        await message.answer('Медиафайлы добавлены. Отправьте еще медиа или Нажмите "Отправить отчет" на задании')
+        media: list = data.setdefault('media', [])
+        for item in messages:
+            if item.photo:
+                media.append(['photo', item.photo[-1].file_id])
+            if item.video:
+                media.append(['video', item.video.file_id])
+            if item.document:
+                media.append(['document', item.document.file_id])
+        await state.set_data(data)
+        if data.get('msg_id'):
+            # Одно изменение задания на альбом: количество медиа на кнопке отправки
+            keyboard = report_keyboard(REPORT_KINDS[data['kind']], datetime.date.fromordinal(data['day']), len(media))
+            with suppress(TelegramBadRequest):
+                await bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=data['msg_id'],
+                                                    reply_markup=keyboard)
+        await message.answer(f'Медиафайлы добавлены, всего {len(media)}. '
+                             f'Отправьте еще медиа или Нажмите "Отправить отчет" на задании')
 
     except Exception as err:
         logger.error(err, exc_info=True)
@@ -68,53 +100,53 @@ async def media_receiver(message: Message, state: FSMContext, bot: Bot):
         await state.clear()
 
 
+@router.callback_query(ReportCallback.filter(F.action == 'x'))
 @router.callback_query(F.data == 'report_reset')
-async def report_reset(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    data = await state.get_data()
-    msg: Message = data.get('msg')
-    await callback.message.edit_caption(caption=msg.caption, reply_markup=report_kb)
+async def report_reset(callback: CallbackQuery, state: FSMContext, bot: Bot,
+                       callback_data: Optional[ReportCallback] = None):
+    callback_data = report_callback_data(callback, callback_data)
     await state.clear()
+    await callback.answer('Отчет сброшен')
+    # Задание снова без количества медиа на кнопке
+    with suppress(TelegramBadRequest):
+        await callback.message.edit_reply_markup(
+            reply_markup=report_keyboard(callback_data.report_type, callback_data.date))
 
 
+@router.callback_query(ReportCallback.filter(F.action == 'c'))
 @router.callback_query(F.data == 'report_confirm')
-async def echo(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def report_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot,
+               callback_data: Optional[ReportCallback] = None):
     """Отправка отчета"""
     logger.debug('report_confirm')
     try:
+        callback_data = report_callback_data(callback, callback_data)
         data = await state.get_data()
         logger.debug(data)
-        media_group = data.get('media_group')
-        if not media_group or not media_group.build():
-            await callback.message.answer('Нет медиа для отправки')
-            return
-        # await callback.message.edit_reply_markup(reply_markup=None)
-        await callback.message.edit_text(text=callback.message.text + '\nОтчет отправлен', reply_markup=report_kb)
-        msg: Message = data.get('msg')
-        media = media_group.build()
+        # Ответы точке - через лимиты рассылки: при flood control ждем, а не теряем ответ
         tg_id = str(callback.from_user.id)
-        name = read_send_list_ids()[tg_id]
-        media[0].caption = f'Отчет от @{callback.from_user.username} ({name})\n' + msg.text
-        await bot.send_media_group(chat_id=conf.tg_bot.admin_ids[0], media=media)
-        await bot.send_media_group(chat_id=conf.tg_bot.admin_ids[1], media=media)
+        if not data.get('media'):
+            await broadcaster.call(tg_id, callback.message.answer, text='Нет медиа для отправки')
+            return
+        msg_text = callback.message.text or ''
+        await broadcaster.call(tg_id, callback.message.edit_text, text=msg_text + '\nОтчет отправлен',
+                               reply_markup=callback.message.reply_markup)
+        media = build_media_group(data['media']).build()
+        name = send_list_store.name(tg_id)
+        media[0].caption = (f'Отчет от @{callback.from_user.username} ({name}) '
+                            f'за {callback_data.date:%d.%m}\n' + msg_text)
         await state.clear()
-        user = get_or_create_user(callback.from_user)
-
-        if 'БАР' in msg.text:
-            logger.debug('Сораняем БАР')
-            save_evening_report(user, 'бар')
-        elif 'олодильни' in msg.text:
-            logger.debug('Сораняем Холодильник')
-            save_evening_report(user)
-        else:
-            logger.debug('Сораняем Отчет')
-            save_report(user)
-        await callback.message.answer('✅отчет отправлен✅')
+        user = await get_or_create_user(callback.from_user)
+        logger.debug('Сохраняем отчет %s', callback_data.report_type)
+        await save_report(user, callback_data.report_type)
+        await broadcaster.call(tg_id, callback.message.answer, text='✅отчет отправлен✅')
+        # Админам отправляется в фоне, повар не ждет доставки
+        admin_fanout.dispatch(bot.send_media_group, media=media)
     except Exception as err:
-        await callback.message.answer('❌отчет не отправлен❌')
+        await broadcaster.call(str(callback.from_user.id), callback.message.answer, text='❌отчет не отправлен❌')
         logger.error(err)
 
 
 @router.callback_query()
-async def echo(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    print('echo')
-    print(callback.data)
\ No newline at end of file
+async def unknown_callback(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    logger.debug('Необработанный callback: %s', callback.data)
\ No newline at end of file
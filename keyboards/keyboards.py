@@ -1,3 +1,6 @@
+import datetime
+
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import KeyboardButton, ReplyKeyboardMarkup,\
     InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
@@ -13,11 +16,13 @@ start_bn: ReplyKeyboardMarkup = ReplyKeyboardMarkup(keyboard=kb, resize_keyboard
 
 kb1 = {
     'Добавить блюдо': 'add_task',
+    'Импорт блюд': 'task_import',
     'Список': 'task_list',
     'Удалить': 'task_del',
     'Редактировать список рассылки': 'send_list_edit',
     'Отчет за 7 дней': 'send_report_7',
     'Отчет за 30 дней': 'send_report_30',
+    'План рассылки': 'broadcast_plan',
     # 'Прислать ответ': 'start_report'
 }
 
@@ -51,6 +56,57 @@ def custom_kb(width: int, buttons_dict: dict, back='', group='', menus='') -> In
 
 report_kb = custom_kb(1, report_btn)
 
+# Тип отчета в callback_data одной буквой
+REPORT_KINDS = {
+    'm': 'утро',
+    'e': 'вечер',
+    'b': 'бар',
+}
+REPORT_KIND_CODES = {report_type: kind for kind, report_type in REPORT_KINDS.items()}
+# Старые callback_data кнопок отчета -> действие
+REPORT_ACTIONS = {
+    'start_report': 's',
+    'report_confirm': 'c',
+    'report_reset': 'x',
+}
+
+
+class ReportCallback(CallbackData, prefix='r'):
+    """Кнопки отчета: действие (s - начать, c - отправить, x - сбросить), тип отчета и день задания"""
+    action: str
+    kind: str
+    day: int  # date.toordinal()
+
+    @property
+    def report_type(self) -> str:
+        return REPORT_KINDS[self.kind]
+
+    @property
+    def date(self) -> datetime.date:
+        return datetime.date.fromordinal(self.day)
+
+
+def report_keyboard(report_type: str, day: datetime.date, media_count: int = 0) -> InlineKeyboardMarkup:
+    """Кнопки отчета для задания типа report_type за day. media_count - сколько медиа в черновике"""
+    kind = REPORT_KIND_CODES[report_type]
+    kb_builder: InlineKeyboardBuilder = InlineKeyboardBuilder()
+    for text, legacy_data in report_btn.items():
+        if legacy_data == 'report_confirm' and media_count:
+            text = f'{text} ({media_count})'
+        kb_builder.button(text=text, callback_data=ReportCallback(
+            action=REPORT_ACTIONS[legacy_data], kind=kind, day=day.toordinal()))
+    kb_builder.adjust(1)
+    return kb_builder.as_markup()
+
+
+def legacy_report_type(text: str) -> str:
+    """Тип отчета по тексту задания - для сообщений, разосланных до ReportCallback"""
+    if 'БАР' in text:
+        return 'бар'
+    if 'олодильни' in text:
+        return 'вечер'
+    return 'утро'
+
 start_kb = custom_kb(1, kb1)
 
 yes_no_kb_btn = {
@@ -70,3 +126,13 @@ nav_btn = {
 }
 
 nav_kb = custom_kb(2, nav_btn)
+
+
+def page_kb(prefix: str, prev_after, next_after, position: str, back: str = '') -> InlineKeyboardMarkup:
+    """Кнопки листания как в nav_kb: страницы по ключу, callback_data - prefix + after_id соседней страницы"""
+    buttons = {
+        '<<': '-' if prev_after is None else f'{prefix}{prev_after}',
+        position: '-',
+        '>>': '-' if next_after is None else f'{prefix}{next_after}',
+    }
+    return custom_kb(3, buttons, back=back)
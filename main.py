@@ -1,228 +1,165 @@
 import asyncio
-import json
-import random
+import datetime
+import functools
 
-import schedule
 from aiogram import Bot, Dispatcher
-from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 
-from config_data.conf import conf, get_my_loggers, BASE_DIR
+from config_data.conf import conf, get_my_loggers
+from database.db import async_engine
 from handlers import user_handlers, admin_handlers
-from keyboards.keyboards import report_kb
-import aioschedule
-
-from services.db_func import get_tasks_to_send, get_expired_cafe, check_user, evening_report_is_ok, \
-    evening_report_bar_is_ok
-from services.func import read_send_list_ids
-
-logger, err_log = get_my_loggers()
-
-
-async def send_task(bot: Bot):
-    try:
-        logger.info('Начинаем рассылку')
-        await asyncio.sleep(random.randint(1, 30))
-        send_list_ids = read_send_list_ids()
-        for send_id, name in send_list_ids.items():
-            try:
-                await asyncio.sleep(0.1)
-                tasks = await get_tasks_to_send(8)
-                logger.info(f'Задачи для {name} {send_id}: {tasks}')
-                task_title = f'{name}\n'
-                for task in tasks:
-                    if task.type == 'photo':
-                        await bot.send_photo(chat_id=send_id, photo=task.image, caption=f'{task.title}\n{task.text}')
-                    elif task.type == 'video':
-                        await bot.send_video(chat_id=send_id, video=task.image, caption=f'{task.title}\n{task.text}')
-                    task_title += f'{task.title}\n'
-                    logger.info(f'Задача {task} пользователю {send_id} отправлена')
-                    await asyncio.sleep(0.1)
-                await bot.send_message(chat_id=send_id, text=task_title, reply_markup=report_kb)
-            except TelegramForbiddenError as err:
-                logger.warning(f'Ошибка отправки сообщения для {send_id}: {err}')
-            except TelegramBadRequest as err:
-                logger.warning(f'Ошибка отправки сообщения для {send_id}: {err}')
-            except Exception as err:
-                logger.error(f'ошибка отправки сообщения пользователю {send_id}: {err}', exc_info=False)
-                err_log.error(f'ошибка отправки сообщения пользователю {send_id}: {err}', exc_info=False)
-
-
-    except Exception as err:
-        logger.error(f'Ошибка дневное рассылки: {err}')
-        err_log.error(err, exc_info=True)
-
-
-async def expired_cafe(bot: Bot):
-    """Ищем ежденевные просрочки после 10.00 и шлём отчет"""
-    try:
-        logger.info(f'Ищем просрочки')
-        expired_cafe_dict: dict = get_expired_cafe()
-        text = ''
-        for tg_id, name in expired_cafe_dict.items():
-            try:
-                await bot.send_message(chat_id=tg_id, text='❌отчет не отправлен❌')
-            except Exception as err:
-                logger.warning(err)
-            text += f'Точка {name} нарушила сроки\n'
-        if text:
-            try:
-                await bot.send_message(chat_id=conf.tg_bot.admin_ids[0], text=text)
-                await bot.send_message(chat_id=conf.tg_bot.admin_ids[1], text=text)
-                await asyncio.sleep(0.1)
-            except TelegramForbiddenError as err:
-                logger.warning(f'Ошибка отправки сообщения отчета по просрочки: {err}')
-            except Exception as err:
-                logger.error(f'Ошибка отправки сообщения отчета по просрочки: {err}', exc_info=False)
-
-        else:
-            logger.info('Просрочек нет')
-
-    except Exception as err:
-        logger.error(f'Ошибка проверки рассылки: {err}')
-
-
-async def end_day_task(bot: Bot):
-    """Задача по уборке холодильника вечером"""
-    text = """Сфотографируй холодильники, микроволновку, рабочие поверхности и стеллажи, сухой склад, овощи."""
-    try:
-        logger.info('Начинаем вечернюю рассылку задачи')
-        send_list_ids = read_send_list_ids()
-        for send_id, name in send_list_ids.items():
-            try:
-                await asyncio.sleep(0.1)
-                await bot.send_message(chat_id=send_id, text=text, reply_markup=report_kb)
-            except TelegramForbiddenError as err:
-                logger.warning(f'Ошибка отправки сообщения по уборке для {send_id}: {err}')
-            except Exception as err:
-                logger.error(f'ошибка отправки сообщения по уборке пользователю {send_id}: {err}', exc_info=False)
-                err_log.error(f'ошибка отправки сообщения по уборке пользователю {send_id}: {err}', exc_info=False)
-    except Exception as err:
-        logger.error(err)
-
-
-async def end_day_task_bar(bot: Bot):
-    """Задача по уборке бара"""
-    text = """БАР - сфотографируй рабочие поверхности, холодильники и кофемашину."""
-    try:
-        logger.info('Начинаем вечернюю рассылку задачи БАР')
-        send_list_ids = read_send_list_ids()
-        for send_id, name in send_list_ids.items():
-            try:
-                await asyncio.sleep(0.1)
-                await bot.send_message(chat_id=send_id, text=text, reply_markup=report_kb)
-            except TelegramForbiddenError as err:
-                logger.warning(f'Ошибка отправки сообщения по уборке для {send_id}: {err}')
-            except Exception as err:
-                logger.error(f'ошибка отправки сообщения по уборке пользователю {send_id}: {err}', exc_info=False)
-                err_log.error(f'ошибка отправки сообщения по уборке пользователю {send_id}: {err}', exc_info=False)
-    except Exception as err:
-        logger.error(err)
-
-
-async def expired_evening_task(bot: Bot):
-    """Ищем вечерние просрочки после 23.00 и шлём отчет"""
-    try:
-        logger.info(f'Ищем вечерние просрочки')
-        povar_dict = read_send_list_ids()
-        text = 'Вечерний отчет\n'
-        for tg_id, name in povar_dict.items():
-            await asyncio.sleep(0.1)
-            user = check_user(tg_id)
-            logger.debug(user)
-            if user:
-                is_ok = evening_report_is_ok(user)
-                if not is_ok:
-                    try:
-                        await bot.send_message(chat_id=tg_id, text='❌отчет не отправлен❌')
-                    except Exception as err:
-                        logger.warning(err)
-                    text += f'Точка @{name} нарушила сроки\n'
-            else:
-                text += f'Точки @{name} нет в базе\n'
-        logger.debug(f'Отчет:\n{text}')
-        await bot.send_message(chat_id=conf.tg_bot.admin_ids[0], text=text)
-        await bot.send_message(chat_id=conf.tg_bot.admin_ids[1], text=text)
-        logger.info(f'Отчет отправлен')
-        await asyncio.sleep(0.1)
-
-    except Exception as err:
-        logger.error(f'Ошибка проверки рассылки: {err}')
-
-
-async def expired_evening_task_bar(bot: Bot):
-    """Ищем вечерние просрочки после 23.00 и шлём отчет"""
-    try:
-        logger.info(f'Ищем вечерние просрочки бара')
-        povar_dict = read_send_list_ids()
-        text = 'Вечерний отчет БАР\n'
-        for tg_id, name in povar_dict.items():
-            await asyncio.sleep(0.1)
-            user = check_user(tg_id)
-            logger.debug(user)
-            if user:
-                is_ok = evening_report_bar_is_ok(user)
-                if not is_ok:
-                    try:
-                        await bot.send_message(chat_id=tg_id, text='❌отчет не отправлен❌')
-                    except Exception as err:
-                        logger.warning(err)
-                    text += f'Точка @{name} нарушила сроки\n'
-            else:
-                text += f'Точки @{name} нет в базе\n'
-        logger.debug(f'Отчет:\n{text}')
-        await bot.send_message(chat_id=conf.tg_bot.admin_ids[0], text=text)
-        await bot.send_message(chat_id=conf.tg_bot.admin_ids[1], text=text)
-        logger.info(f'Отчет отправлен')
-        await asyncio.sleep(0.1)
-
-    except Exception as err:
-        logger.error(f'Ошибка проверки рассылки: {err}')
-
-
-async def shedulers(bot):
-    """11:00 это 12:00 Мск"""
-    time_start1 = '8:00'
-    time_end = '11:00'
-    aioschedule.every().day.at(time_start1).do(send_task, bot)
-    aioschedule.every().day.at(time_end).do(expired_cafe, bot)
-    # aioschedule.every(5).seconds.do(expired_cafe, bot)
-    aioschedule.every().day.at('20:00').do(end_day_task, bot)
-    end_day_task_time = '23:59'
-    aioschedule.every().day.at(end_day_task_time).do(expired_evening_task, bot)
-    aioschedule.every().day.at('20:01').do(end_day_task_bar, bot)
-    aioschedule.every().day.at('23:59').do(expired_evening_task_bar, bot)
-
-    while True:
-        await aioschedule.run_pending()
-        await asyncio.sleep(5)
+from keyboards.keyboards import report_keyboard
+from services.admin_fanout import admin_fanout
+from services.db_func import get_tasks_to_send
+from services.delivery import task_calls, message_call
+from services.fsm_storage import get_fsm_storage
+from services.jobs import JobDef, job_dispatcher
+from services.leader import leader
+from services.metrics import instrument, job_metrics, start_server
+from services.outbox import outbox
+from services.reports import DayCompliance, get_day_compliance
+from services.scheduler import scheduler
+from services.webhook import run_webhook
+
+logger, err_log = get_my_loggers(__name__)
+
+ALLOWED_UPDATES = ["message", "my_chat_member", "chat_member", "callback_query"]
+
+
+async def build_task_messages(job: JobDef, cafes: dict, day: datetime.date) -> dict:
+    """Рассылка задач дня {tg_id: вызовы}: job.count задач каждой точке и сообщение с кнопками отчета"""
+    keyboard = report_keyboard(job.report_type, day)
+    messages = {}
+    for send_id, name in cafes.items():
+        tasks = await get_tasks_to_send(job.count, send_id)
+        logger.debug('Задачи для %s %s: %s', name, send_id, tasks)
+        task_title = f'{name}\n' + ''.join(f'{task.title}\n' for task in tasks)
+        messages[send_id] = task_calls(tasks) + [message_call(task_title, keyboard)]
+    return messages
+
+
+async def plan_task(job: JobDef, cafes: dict, day: datetime.date, cafe_tz, send_at: datetime.datetime,
+                    replace: bool = False) -> int:
+    """
+    План рассылки задач дня: сообщения собираются заранее и ставятся в очередь со временем отправки send_at.
+    replace - заменить еще не начатый план (новый выбор задач)
+    """
+    if replace:
+        cancelled = await outbox.cancel(job.name, cafes, day)
+        logger.info('План %s за %s: удалено %s сообщений', job.name, day, cancelled)
+    queued = await outbox.queued(job.name, cafes, day)
+    rest = {tg_id: name for tg_id, name in cafes.items() if tg_id not in queued}
+    return await outbox.enqueue(job.name, await build_task_messages(job, rest, day), day=day, not_before=send_at)
+
+
+async def send_task(bot: Bot, job: JobDef, cafes: dict, day: datetime.date, cafe_tz) -> int:
+    """Задачи дня: план уже в очереди, собираются только точки без плана (например, добавленные позже)"""
+    logger.info('Начинаем рассылку %s', job.name)
+    planned = await outbox.queued(job.name, cafes, day)
+    rest = {tg_id: name for tg_id, name in cafes.items() if tg_id not in planned}
+    if planned:
+        logger.info('%s: план готов для %s точек, собираем для %s', job.name, len(planned), len(rest))
+    outbox.wake()
+    if not rest:
+        return 0
+    return await outbox.enqueue(job.name, await build_task_messages(job, rest, day), day=day)
+
+
+async def notify_expired(expired: dict, job: str, day: datetime.date) -> int:
+    """Рассылает точкам из expired сообщение о просрочке"""
+    return await outbox.enqueue(job, {tg_id: [message_call('❌отчет не отправлен❌')] for tg_id in expired}, day=day)
+
+
+async def send_text_task(job: JobDef, cafes: dict, day: datetime.date, cafe_tz) -> int:
+    """Рассылает точкам текстовое задание с кнопками отчета"""
+    logger.info('Начинаем рассылку задачи %s', job.name)
+    keyboard = report_keyboard(job.report_type, day)
+    return await outbox.enqueue(job.name, {send_id: [message_call(job.text, keyboard)] for send_id in cafes},
+                                day=day)
+
+
+async def send_check_report(bot: Bot, compliance: DayCompliance, check: dict) -> int:
+    """
+    Сообщает точкам о просрочке check['report_type'] и шлет отчет админам.
+    Отчет с заголовком (title) отправляется всегда, без заголовка - только при нарушениях.
+    unknown_expired - точки без пользователя в базе считаются просрочившими и получают уведомление,
+    mention=false - названия точек в отчете без @.
+    Возвращает количество поставленных в очередь уведомлений
+    """
+    report_type = check['report_type']
+    mention = '@' if check.get('mention', True) else ''
+    text = f"{check['title']}\n" if check.get('title') else ''
+    expired = {}
+    for tg_id, name in compliance.send_list.items():
+        if tg_id in compliance.unknown and not check.get('unknown_expired'):
+            text += f'Точки {mention}{name} нет в базе\n'
+        elif tg_id in compliance.unknown or tg_id in compliance.noncompliant[report_type]:
+            expired[tg_id] = name
+            text += f'Точка {mention}{name} нарушила сроки\n'
+    queued = await notify_expired(expired, check['job'], compliance.day)
+    logger.debug('Отчет:\n%s', text)
+    if not text:
+        logger.info('Просрочек нет')
+        return queued
+    await admin_fanout.send(bot.send_message, text=text)
+    logger.info('Отчет отправлен')
+    return queued
+
+
+async def check_reports(bot: Bot, job: JobDef, cafes: dict, day: datetime.date, cafe_tz) -> int:
+    """Проверка отчетов job.report_types одним запросом и отчеты по каждому типу"""
+    logger.info('Ищем просрочки %s', job.name)
+    compliance = await get_day_compliance(job.report_types, day, *job.hours, cafes=cafes, day_tz=cafe_tz)
+    queued = 0
+    for check in job.checks:
+        queued += await send_check_report(bot, compliance, check)
+    return queued
+
+
+def shedulers(bot):
+    """
+    Задачи описаны в config_data/jobs.json, время - в часовом поясе точки.
+    Обработчики возвращают количество сообщений, поставленных в очередь; ошибки логирует планировщик.
+    Планировщик и очередь рассылки работают только у лидера (services.leader)
+    """
+    job_dispatcher.register('tasks', job_metrics(functools.partial(send_task, bot)), planner=plan_task)
+    job_dispatcher.register('text', job_metrics(send_text_task))
+    job_dispatcher.register('check', job_metrics(functools.partial(check_reports, bot)))
+    job_dispatcher.setup()
+    return asyncio.create_task(leader.run(scheduler.run, functools.partial(outbox.run, bot)))
 
 
 async def main():
     logger.info('Starting bot')
     bot: Bot = Bot(token=conf.tg_bot.token, parse_mode='HTML')
-    dp: Dispatcher = Dispatcher()
+    dp: Dispatcher = Dispatcher(storage=get_fsm_storage())
     dp.include_router(admin_handlers.router)
     dp.include_router(user_handlers.router)
-    await bot.delete_webhook(drop_pending_updates=True)
+    instrument(dp, async_engine)
+    metrics_runner = await start_server()
+    if not conf.webhook.enabled:
+        await bot.delete_webhook(drop_pending_updates=True)
 
     try:
         admins = conf.tg_bot.admin_ids
         if admins:
             await bot.send_message(
                 conf.tg_bot.admin_ids[0], f'Бот запущен.')
-            logger.debug(f'Бот запущен.')
+            logger.debug('Бот запущен.')
     except:
-        err_log.critical(f'Не могу отравить сообщение {conf.tg_bot.admin_ids[0]}')
-    # await send_task(bot)
-    # all_jobs = schedule.get_jobs()
-    # print(all_jobs)
-    # await send_task(bot)
-    # await end_day_task(bot)
-    # await expired_evening_task(bot)
-    # await end_day_task_bar(bot)
-    # await expired_evening_task_bar(bot)
-    asyncio.create_task(shedulers(bot))
-    await dp.start_polling(bot, allowed_updates=["message", "my_chat_member", "chat_member", "callback_query"])
+        err_log.critical('Не могу отравить сообщение %s', conf.tg_bot.admin_ids[0])
+    leader_task = shedulers(bot)
+    try:
+        if conf.webhook.enabled:
+            await run_webhook(bot, dp, ALLOWED_UPDATES)
+        else:
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        leader_task.cancel()
+        await asyncio.gather(leader_task, return_exceptions=True)
+        await dp.storage.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await async_engine.dispose()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List
+
+from aiogram.exceptions import TelegramForbiddenError
+
+from config_data.conf import conf, get_my_loggers
+from services.broadcast import broadcaster
+
+logger, err_log = get_my_loggers(__name__)
+
+
+class AdminFanout:
+    """
+    Рассылка одного сообщения всем админам.
+    Админы получают сообщение параллельно, ошибка у одного не мешает остальным;
+    неудачные отправки повторяются в фоне с растущей паузой.
+    """
+
+    def __init__(self, admin_ids: List[str], retries: int = 3, backoff: float = 5.0):
+        self.admin_ids = admin_ids
+        self.retries = retries
+        self.backoff = backoff
+        self._background: set = set()
+
+    def _in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def _send_one(self, admin_id, method: Callable[..., Awaitable], kwargs: dict):
+        return await broadcaster.call(admin_id, method, chat_id=admin_id, **kwargs)
+
+    async def _retry(self, admin_id, method: Callable[..., Awaitable], kwargs: dict):
+        for attempt in range(1, self.retries + 1):
+            await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                await self._send_one(admin_id, method, kwargs)
+                logger.info('Сообщение админу %s отправлено с попытки %s', admin_id, attempt + 1)
+                return
+            except TelegramForbiddenError as err:
+                logger.warning('Админ %s заблокировал бота: %s', admin_id, err)
+                return
+            except Exception as err:
+                logger.warning('Повтор %s отправки админу %s не удался: %s', attempt, admin_id, err)
+        err_log.error('Сообщение админу %s не доставлено за %s попыток', admin_id, self.retries + 1)
+
+    async def send(self, method: Callable[..., Awaitable], **kwargs) -> Dict[str, Exception]:
+        """
+        Отправляет всем админам параллельно: send(bot.send_message, text=text).
+        Возвращает ошибки первой попытки {admin_id: ошибка}, повторы идут в фоне
+        """
+        results = await asyncio.gather(
+            *[self._send_one(admin_id, method, kwargs) for admin_id in self.admin_ids], return_exceptions=True)
+        errors = {}
+        for admin_id, result in zip(self.admin_ids, results):
+            if isinstance(result, Exception):
+                logger.warning('Ошибка отправки админу %s: %s', admin_id, result)
+                errors[admin_id] = result
+                if not isinstance(result, TelegramForbiddenError):
+                    self._in_background(self._retry(admin_id, method, kwargs))
+        return errors
+
+    def dispatch(self, method: Callable[..., Awaitable], **kwargs) -> asyncio.Task:
+        """То же, что send, но не ждет доставки"""
+        return self._in_background(self.send(method, **kwargs))
+
+
+admin_fanout = AdminFanout(conf.tg_bot.admin_ids)
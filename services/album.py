@@ -0,0 +1,31 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.types import Message
+
+
+class AlbumCollector:
+    """
+    Собирает сообщения одного альбома (media_group_id), которые приходят отдельными апдейтами.
+    collect() ждет window секунд после последнего сообщения альбома: вызов с последним
+    сообщением получает весь альбом, остальные - None.
+    """
+
+    def __init__(self, window: float = 0.6):
+        self.window = window
+        self._albums: Dict[Tuple[int, str], List[Message]] = {}
+
+    async def collect(self, message: Message) -> Optional[List[Message]]:
+        if not message.media_group_id:
+            return [message]
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.setdefault(key, [])
+        album.append(message)
+        count = len(album)
+        await asyncio.sleep(self.window)
+        if len(self._albums.get(key, ())) != count:
+            return None
+        return sorted(self._albums.pop(key), key=lambda item: item.message_id)
+
+
+album_collector = AlbumCollector()
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List
+
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+from config_data.conf import conf, get_my_loggers
+from services.metrics import metrics
+
+logger, err_log = get_my_loggers(__name__)
+
+
+class TokenBucket:
+    """Токен-бакет: не больше rate вызовов в секунду, пачкой до capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Блокирует бакет на seconds (после TelegramRetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    @property
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return now >= self.blocked_until and not self._lock.locked() \
+            and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+@dataclass
+class BroadcastResult:
+    sent: int = 0
+    forbidden: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+
+    def __repr__(self):
+        return f'Отправлено: {self.sent}, заблокировали: {len(self.forbidden)}, ошибок: {len(self.failed)}'
+
+
+class Broadcaster:
+    """
+    Движок рассылки.
+    Все вызовы Bot API идут через call(): общий бакет на бота и отдельный бакет на каждый чат,
+    при TelegramRetryAfter чат ставится на паузу и запрос повторяется.
+    broadcast() раздает получателей пулу воркеров, так что медленная точка не тормозит остальные.
+    """
+
+    def __init__(self, workers: int = 16, global_rate: float = 25, chat_rate: float = 1,
+                 chat_burst: int = 5, max_retries: int = 3):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        chat_id = str(chat_id)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {key: val for key, val in self._chats.items() if not val.idle}
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def call(self, target, method: Callable[..., Awaitable], /, *, chat_limit: bool = True, **kwargs):
+        """
+        Вызов метода бота с учетом лимитов. target - чат, в который идет запрос.
+        chat_limit=False - только общий лимит, например для загрузки файлов в служебный чат
+        """
+        bucket = self._chat_bucket(target)
+        for attempt in range(self.max_retries + 1):
+            if chat_limit:
+                await bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await method(**kwargs)
+            except TelegramRetryAfter as err:
+                metrics.inc('bot_telegram_errors_total', method=method.__name__, error=type(err).__name__)
+                logger.warning('Flood control для %s: ждем %s с.', target, err.retry_after)
+                bucket.pause(err.retry_after)
+                if attempt == self.max_retries:
+                    raise
+                if not chat_limit:
+                    await asyncio.sleep(err.retry_after)
+            except TelegramAPIError as err:
+                metrics.inc('bot_telegram_errors_total', method=method.__name__, error=type(err).__name__)
+                raise
+
+    async def broadcast(self, targets: dict, sender: Callable[[str, str], Awaitable],
+                        title: str = 'рассылка') -> BroadcastResult:
+        """
+        Рассылка по словарю {tg_id: название}.
+        sender(tg_id, name) отправляет все сообщения одной точке через self.call
+        """
+        result = BroadcastResult()
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in targets.items():
+            queue.put_nowait(item)
+
+        async def worker():
+            while True:
+                try:
+                    send_id, name = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await sender(send_id, name)
+                    result.sent += 1
+                except TelegramForbiddenError as err:
+                    logger.warning('Ошибка отправки сообщения (%s) для %s: %s', title, send_id, err)
+                    result.forbidden.append(send_id)
+                except TelegramBadRequest as err:
+                    logger.warning('Ошибка отправки сообщения (%s) для %s: %s', title, send_id, err)
+                    result.failed[send_id] = str(err)
+                except Exception as err:
+                    logger.error('ошибка отправки сообщения (%s) пользователю %s: %s', title, send_id, err)
+                    err_log.error('ошибка отправки сообщения (%s) пользователю %s: %s', title, send_id, err)
+                    result.failed[send_id] = str(err)
+
+        started = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(min(self.workers, len(targets)))])
+        logger.info('%s: %s за %.1f с.', title, result, time.monotonic() - started)
+        return result
+
+
+broadcaster = Broadcaster(workers=conf.logic.broadcast_workers,
+                          global_rate=conf.logic.broadcast_global_rate,
+                          chat_rate=conf.logic.broadcast_chat_rate,
+                          chat_burst=conf.logic.broadcast_chat_burst)
@@ -0,0 +1,92 @@
+"""
+Сообщения рассылки в виде данных: список вызовов {'method': ..., 'params': {...}}.
+Такой список можно сохранить в очередь (services.outbox) и выполнить позже через execute_calls.
+"""
+from typing import List, Sequence
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.media_group import MediaGroupBuilder
+
+from config_data.conf import conf, get_my_loggers
+from database.db import Task
+from services.broadcast import broadcaster
+
+logger, err_log = get_my_loggers(__name__)
+
+MAX_ALBUM_SIZE = 10
+MAX_CAPTION_LENGTH = 1024
+
+
+def task_caption(task: Task) -> str:
+    return f'{task.title}\n{task.text}'[:MAX_CAPTION_LENGTH]
+
+
+def build_albums(tasks: Sequence[Task]) -> List[List[Task]]:
+    """Делит задачи на альбомы по 10 штук (ограничение send_media_group)"""
+    tasks = [task for task in tasks if task.type in ('photo', 'image', 'video')]
+    return [tasks[i:i + MAX_ALBUM_SIZE] for i in range(0, len(tasks), MAX_ALBUM_SIZE)]
+
+
+def single_task_call(task: Task) -> dict:
+    if task.type == 'video':
+        return {'method': 'send_video', 'params': {'video': task.image, 'caption': task_caption(task)}}
+    return {'method': 'send_photo', 'params': {'photo': task.image, 'caption': task_caption(task)}}
+
+
+def album_call(tasks: Sequence[Task]) -> dict:
+    """Альбом из задач. Если альбом отклонен, выполняется fallback - задачи по одной"""
+    if len(tasks) == 1:
+        return single_task_call(tasks[0])
+    media = [{'type': 'video' if task.type == 'video' else 'photo', 'media': task.image,
+              'caption': task_caption(task)} for task in tasks]
+    return {'method': 'send_media_group', 'params': {'media': media},
+            'fallback': [single_task_call(task) for task in tasks]}
+
+
+def task_calls(tasks: Sequence[Task], mode: str = None) -> List[dict]:
+    """Вызовы для отправки задач: альбомами (mode='album') или по одной (mode='single')"""
+    mode = mode or conf.logic.delivery_mode
+    if mode == 'album':
+        return [album_call(album) for album in build_albums(tasks)]
+    return [single_task_call(task) for task in tasks if task.type in ('photo', 'image', 'video')]
+
+
+def message_call(text: str, reply_markup: InlineKeyboardMarkup = None) -> dict:
+    params = {'text': text}
+    if reply_markup is not None:
+        params['reply_markup'] = reply_markup.model_dump(exclude_none=True)
+    return {'method': 'send_message', 'params': params}
+
+
+async def execute_call(bot: Bot, chat_id, call: dict):
+    """Выполняет один вызов из списка с учетом лимитов рассылки"""
+    params = dict(call['params'])
+    if 'reply_markup' in params:
+        params['reply_markup'] = InlineKeyboardMarkup.model_validate(params['reply_markup'])
+    if call['method'] == 'send_media_group':
+        media_group = MediaGroupBuilder()
+        for item in params['media']:
+            media_group.add(**item)
+        params['media'] = media_group.build()
+        try:
+            return await broadcaster.call(chat_id, bot.send_media_group, chat_id=chat_id, **params)
+        except TelegramBadRequest as err:
+            if not call.get('fallback'):
+                raise
+            logger.warning('Альбом для %s отклонен: %s. Отправляем по одной', chat_id, err)
+            for fallback_call in call['fallback']:
+                await execute_call(bot, chat_id, fallback_call)
+            return
+    return await broadcaster.call(chat_id, getattr(bot, call['method']), chat_id=chat_id, **params)
+
+
+async def execute_calls(bot: Bot, chat_id, calls: Sequence[dict]):
+    for call in calls:
+        await execute_call(bot, chat_id, call)
+
+
+async def send_tasks(bot: Bot, chat_id, tasks: Sequence[Task], mode: str = None):
+    """Отправляет задачи точке: альбомами (mode='album') или по одной (mode='single')"""
+    await execute_calls(bot, chat_id, task_calls(tasks, mode))
@@ -0,0 +1,194 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config_data.conf import conf, get_my_loggers
+from database.db import async_session, FSMRecord
+
+logger, err_log = get_my_loggers(__name__)
+
+
+def fsm_key(key: StorageKey) -> str:
+    return f'{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ""}:{key.destiny}'
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в sqlite (WAL), переживает перезапуск бота.
+    При первом обращении все записи читаются одним запросом в память, дальше чтение идет из памяти.
+    Изменения копятся в буфере и пишутся одной транзакцией раз в flush_interval секунд и при close().
+    Данные хранятся как JSON, поэтому в состояние можно класть только сериализуемые значения.
+    Файл и снимок в памяти - свои у каждого экземпляра: для нескольких экземпляров за балансировщиком
+    нужно общее хранилище DatabaseStorage (FSM_STORAGE=db).
+    """
+
+    def __init__(self, path: Path, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db: Optional[aiosqlite.Connection] = None
+        self._items: Dict[str, Tuple[Optional[str], str]] = {}
+        self._dirty: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_now = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    _key = staticmethod(fsm_key)
+
+    async def _connect(self):
+        if self._db is not None:
+            return
+        async with self._lock:
+            if self._db is not None:
+                return
+            db = await aiosqlite.connect(self.path)
+            await db.execute('PRAGMA journal_mode=WAL')
+            await db.execute('PRAGMA synchronous=NORMAL')
+            await db.execute('CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT)')
+            await db.commit()
+            async with db.execute('SELECT key, state, data FROM fsm') as cursor:
+                async for key, state, data in cursor:
+                    self._items.setdefault(key, (state, data))
+            self._db = db
+            logger.debug('FSM: загружено %s записей из %s', len(self._items), self.path)
+
+    def _set(self, key: str, state: Optional[str], data: str):
+        self._items[key] = (state, data)
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # Изменения, пришедшие во время записи, пишутся следующим кругом
+        while self._dirty:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as err:
+                err_log.error('Ошибка записи FSM: %s', err, exc_info=True)
+                if self._flush_now.is_set():
+                    return
+
+    async def flush(self):
+        """Пишет накопленные изменения одной транзакцией"""
+        if not self._dirty or self._db is None:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upsert, remove = [], []
+        for key in dirty:
+            state, data = self._items.get(key, (None, '{}'))
+            if state is None and data == '{}':
+                remove.append((key,))
+                self._items.pop(key, None)
+            else:
+                upsert.append((key, state, data))
+        try:
+            if upsert:
+                await self._db.executemany(
+                    'INSERT INTO fsm (key, state, data) VALUES (?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data', upsert)
+            if remove:
+                await self._db.executemany('DELETE FROM fsm WHERE key = ?', remove)
+            await self._db.commit()
+        except BaseException:
+            # В том числе отмена: ключи остаются в буфере до следующей записи
+            self._dirty |= dirty
+            raise
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._connect()
+        state = state.state if isinstance(state, State) else state
+        storage_key = self._key(key)
+        self._set(storage_key, state, self._items.get(storage_key, (None, '{}'))[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        await self._connect()
+        return self._items.get(self._key(key), (None, '{}'))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._connect()
+        storage_key = self._key(key)
+        self._set(storage_key, self._items.get(storage_key, (None, '{}'))[0], json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        await self._connect()
+        return json.loads(self._items.get(self._key(key), (None, '{}'))[1])
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_now.set()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        if self._db is not None:
+            await self.flush()
+            await self._db.close()
+            self._db = None
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    FSM-хранилище в основной базе (таблица fsm_states), общее для всех экземпляров бота.
+    Каждое чтение и запись идут в базу, без кэша: черновик, начатый на одном экземпляре,
+    виден на остальных. Данные хранятся как JSON.
+    """
+
+    async def _save(self, key: StorageKey, state=..., data=...):
+        async with async_session() as session:
+            record = await session.get(FSMRecord, fsm_key(key))
+            if record is None:
+                record = FSMRecord(key=fsm_key(key), state=None, data='{}')
+            if state is not ...:
+                record.state = state
+            if data is not ...:
+                record.data = data
+            if record.state is None and record.data == '{}':
+                if record in session:
+                    await session.delete(record)
+            else:
+                session.add(record)
+            await session.commit()
+
+    async def _get(self, key: StorageKey) -> Tuple[Optional[str], str]:
+        async with async_session() as session:
+            record = await session.get(FSMRecord, fsm_key(key))
+        return (record.state, record.data) if record is not None else (None, '{}')
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._save(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._save(key, data=json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return json.loads((await self._get(key))[1])
+
+    async def close(self) -> None:
+        pass
+
+
+def get_fsm_storage() -> BaseStorage:
+    """
+    Хранилище FSM по настройке FSM_STORAGE: sqlite, db или memory.
+    С вебхуком по умолчанию db. Вебхук с выбором лидера через базу (WEBHOOK=true, LEADER_BACKEND=db) -
+    обычно несколько экземпляров за балансировщиком: с локальным хранилищем черновик с одного экземпляра
+    не виден на другом, об этом предупреждаем в логе
+    """
+    storage = conf.logic.fsm_storage
+    if conf.webhook.enabled and conf.logic.leader_backend == 'db' and storage != 'db':
+        logger.warning('FSM_STORAGE=%s хранит состояние только в этом экземпляре бота: для нескольких экземпляров '
+                       'нужно FSM_STORAGE=db', storage)
+    if storage == 'sqlite':
+        return SQLiteStorage(conf.logic.fsm_db_path)
+    if storage == 'db':
+        return DatabaseStorage()
+    return MemoryStorage()
@@ -1,8 +1,14 @@
+import datetime
 import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
 
-from config_data.conf import BASE_DIR, get_my_loggers
+from config_data.conf import BASE_DIR, get_my_loggers, tz
 
-logger, err_log = get_my_loggers()
+logger, err_log = get_my_loggers(__name__)
 
 
 data = {
@@ -18,18 +24,90 @@ data = {
 }
 
 
+def local_day_range(day: datetime.date, start_hour: int = 0, end_hour: int = 24, day_tz=None):
+    """
+    Полуоткрытый интервал [day start_hour:00, day end_hour:00) в часовом поясе day_tz (по умолчанию бота).
+    Условие Report.date >= start AND Report.date < end использует индекс по дате
+    """
+    day_tz = day_tz or tz
+    midnight = datetime.datetime.combine(day, datetime.time.min)
+    start = day_tz.localize(midnight + datetime.timedelta(hours=start_hour))
+    end = day_tz.localize(midnight + datetime.timedelta(hours=end_hour))
+    if day_tz is not tz:
+        # Отчеты хранятся во времени бота
+        start, end = start.astimezone(tz), end.astimezone(tz)
+    return start, end
+
+
+class SendListStore:
+    """
+    Список рассылки {tg_id: название} из send_list.txt.
+    Разобранный словарь хранится в памяти и перечитывается, только если у файла сменились
+    mtime/inode/размер. stat() делается не чаще раза в check_interval секунд.
+    Запись атомарная: временный файл + os.replace.
+    """
+
+    def __init__(self, path: Path, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._data: Optional[dict] = None
+        self._file_key = None
+        self._checked_at = 0.0
+
+    def _stat_key(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    def _load(self):
+        logger.debug('Чтение списка рассылки')
+        file_key = self._stat_key()
+        with open(self.path, encoding='utf-8') as file:
+            self._data = json.load(file)
+        self._file_key = file_key
+        logger.debug('Список прочитан:%s', self._data)
+
+    def get(self) -> dict:
+        """Текущий список. Возвращается общий словарь - не изменять"""
+        now = time.monotonic()
+        if self._data is None:
+            self._load()
+            self._checked_at = now
+        elif now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            if self._stat_key() != self._file_key:
+                self._load()
+        return self._data
+
+    def name(self, tg_id) -> Optional[str]:
+        return self.get().get(str(tg_id))
+
+    def write(self, data: dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f'.{self.path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._data = dict(data)
+        self._file_key = self._stat_key()
+        self._checked_at = time.monotonic()
+
+
+send_list_store = SendListStore(BASE_DIR / 'send_list.txt')
+
+
 def write_send_list_ids(data: dict):
-    with open(BASE_DIR / 'send_list.txt', 'w', encoding='utf-8') as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+    send_list_store.write(data)
 
 
 def read_send_list_ids() -> dict:
-    logger.debug('Чтение списка рассылки')
     try:
-        with open(BASE_DIR / 'send_list.txt', encoding='utf-8') as file:
-            send_list_ids = json.load(file)
-            logger.debug(f'Список прочитан:{send_list_ids}')
-            return send_list_ids
+        return dict(send_list_store.get())
     except Exception as err:
         logger.error(err)
         err_log.error(err, exc_info=True)
@@ -37,5 +115,3 @@ def read_send_list_ids() -> dict:
 
 # write_send_list_ids({"6247356284": "TestJ"})
 # write_send_list_ids(data)
-x = read_send_list_ids()
-print(x.keys())
\ No newline at end of file
@@ -0,0 +1,323 @@
+"""
+Задачи рассылки и проверок из файла config_data/jobs.json (путь - JOBS_CONFIG):
+
+{
+    "windows": {"утро": [8, 11], ...},
+    "jobs": {
+        "morning": {"kind": "tasks", "at": "8:00", "report_type": "утро", "count": 8, "plan": 120},
+        "evening": {"kind": "text", "at": "20:00", "report_type": "вечер", "text": "..."},
+        "expired_evening": {"kind": "check", "at": "23:59", "hours": [0, 23], "catch_up": 5,
+                            "checks": [{"report_type": "вечер", "title": "Вечерний отчет", "job": "expired_evening"}]}
+    },
+    "cafes": {
+        "<tg_id>": {"tz": "Asia/Yekaterinburg", "jobs": {"morning": "9:00", "bar": null},
+                    "windows": {"утро": [9, 12]}}
+    }
+}
+
+windows - часы [начало, конец), в которые отчет считается сданным вовремя (во времени бота, как хранятся отчеты).
+report_type рассылки попадает в кнопки отчета и определяет тип сохраненного отчета.
+at и hours проверки - в часовом поясе точки (tz, по умолчанию TIMEZONE бота), catch_up - минуты, в течение
+которых пропущенный запуск выполняется после перезапуска. В cafes задаются отличия точек: часовой пояс,
+свое время задач (null - задача точке не отправляется) и свои окна отчетов.
+Проверка (checks) сообщает о нарушениях отчета report_type админам (с заголовком title) и точкам (задача job).
+unknown_expired - точка без пользователя в базе считается просрочившей, mention=false - названия точек без @.
+plan - за сколько минут до at заранее собрать рассылку (план) и поставить ее в очередь со временем отправки at.
+Работает для видов задач, у которых зарегистрирован planner; в момент at остается только отправка.
+"""
+import datetime
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import pytz
+
+from config_data.conf import conf, tz, get_my_loggers
+from services.func import read_send_list_ids
+from services.scheduler import Scheduler, scheduler, local_fire_time, fire_time, scheduled_date
+
+logger, err_log = get_my_loggers(__name__)
+
+
+def parse_time(value: str) -> datetime.time:
+    hour, minute = map(int, value.split(':'))
+    return datetime.time(hour, minute)
+
+
+def time_before(at: datetime.time, minutes: int) -> datetime.time:
+    """Время за minutes минут до at (через полночь - накануне)"""
+    return (datetime.datetime.combine(datetime.date(2000, 1, 2), at) - datetime.timedelta(minutes=minutes)).time()
+
+
+@dataclass
+class JobDef:
+    name: str
+    kind: str  # tasks - задачи дня, text - текстовое задание, check - проверка отчетов
+    at: datetime.time
+    report_type: str = ''
+    text: str = ''
+    count: int = 8
+    hours: Tuple[int, int] = (0, 24)
+    catch_up: int = 60
+    checks: List[dict] = field(default_factory=list)
+    plan: int = 0  # За сколько минут до at собрать план рассылки, 0 - без плана
+
+    @property
+    def report_types(self) -> List[str]:
+        return [check['report_type'] for check in self.checks]
+
+
+@dataclass
+class CafeSettings:
+    tz: datetime.tzinfo = tz
+    times: Dict[str, Optional[datetime.time]] = field(default_factory=dict)
+    windows: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+
+
+class JobBook:
+    """Описание задач и настройки точек"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.windows: Dict[str, Tuple[int, int]] = {}
+        self.jobs: Dict[str, JobDef] = {}
+        self.cafes: Dict[str, CafeSettings] = {}
+        self.load()
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as file:
+            data = json.load(file)
+        windows = {report_type: tuple(window) for report_type, window in data['windows'].items()}
+        jobs = {}
+        for name, job in data['jobs'].items():
+            jobs[name] = JobDef(name=name, kind=job['kind'], at=parse_time(job['at']),
+                                report_type=job.get('report_type', ''), text=job.get('text', ''),
+                                count=job.get('count', 8), hours=tuple(job.get('hours', (0, 24))),
+                                catch_up=job.get('catch_up', 60), checks=job.get('checks', []),
+                                plan=job.get('plan', 0))
+        cafes = {}
+        for tg_id, cafe in data.get('cafes', {}).items():
+            cafes[str(tg_id)] = CafeSettings(
+                tz=pytz.timezone(cafe['tz']) if cafe.get('tz') else tz,
+                times={name: parse_time(at) if at else None for name, at in cafe.get('jobs', {}).items()},
+                windows={report_type: tuple(window) for report_type, window in cafe.get('windows', {}).items()},
+            )
+        self.windows, self.jobs, self.cafes = windows, jobs, cafes
+        logger.info('Задачи загружены из %s: %s, настроек точек: %s', self.path, list(jobs), len(cafes))
+
+    def cafe_tz(self, tg_id) -> datetime.tzinfo:
+        cafe = self.cafes.get(str(tg_id))
+        return cafe.tz if cafe else tz
+
+    def job_time(self, job_name: str, tg_id) -> Optional[datetime.time]:
+        """Время задачи для точки (None - задача точке не отправляется)"""
+        cafe = self.cafes.get(str(tg_id))
+        if cafe and job_name in cafe.times:
+            return cafe.times[job_name]
+        return self.jobs[job_name].at
+
+    def window(self, report_type: str, tg_id=None) -> Tuple[int, int]:
+        cafe = self.cafes.get(str(tg_id)) if tg_id is not None else None
+        if cafe and report_type in cafe.windows:
+            return cafe.windows[report_type]
+        return self.windows[report_type]
+
+    def window_groups(self, report_type: str, tg_ids: Iterable[str]) -> Dict[Tuple[int, int], List[str]]:
+        """{окно: точки} - точки, сгруппированные по окну отчета report_type"""
+        groups = {}
+        for tg_id in tg_ids:
+            groups.setdefault(self.window(report_type, tg_id), []).append(tg_id)
+        return groups
+
+    def groups(self, send_list: Iterable[str]) -> Dict[Tuple[str, datetime.tzinfo, datetime.time], List[str]]:
+        """{(задача, часовой пояс, время): точки}"""
+        groups = {}
+        for tg_id in send_list:
+            cafe_tz = self.cafe_tz(tg_id)
+            for name in self.jobs:
+                at = self.job_time(name, tg_id)
+                if at is not None:
+                    groups.setdefault((name, cafe_tz, at), []).append(tg_id)
+        return groups
+
+    def is_default(self, job_name: str, group_tz: datetime.tzinfo, at: datetime.time) -> bool:
+        return group_tz is tz and at == self.jobs[job_name].at
+
+
+class DispatchIndex:
+    """
+    Индекс запусков по минутам: {минута UTC: {группа: точки}} на вчера, сегодня и завтра.
+    По времени запуска точки находятся одним обращением к словарю.
+    Запуск дальше суток от момента сборки индексом не покрыт (covers) - индекс нужно пересобрать.
+    """
+
+    def __init__(self):
+        self.by_minute: Dict[int, Dict[str, List[str]]] = {}
+        self.known: set = set()
+        self.built_at: Optional[datetime.datetime] = None
+
+    @staticmethod
+    def minute(moment: datetime.datetime) -> int:
+        return int(moment.timestamp()) // 60
+
+    def build(self, groups: Dict[str, Tuple[datetime.tzinfo, datetime.time, List[str]]], now: datetime.datetime):
+        """groups: {группа: (часовой пояс, время, точки)}"""
+        by_minute = {}
+        known = set()
+        for group, (group_tz, at, tg_ids) in groups.items():
+            known.update(tg_ids)
+            today = now.astimezone(group_tz).date()
+            for shift in (-1, 0, 1):
+                fire = local_fire_time(today + datetime.timedelta(days=shift), at, group_tz)
+                by_minute.setdefault(self.minute(fire), {})[group] = tg_ids
+        self.by_minute, self.known, self.built_at = by_minute, known, now
+
+    def covers(self, moment: datetime.datetime) -> bool:
+        # В любом часовом поясе сутки от момента сборки попадают во вчера, сегодня или завтра
+        return self.built_at is not None and abs(moment - self.built_at) < datetime.timedelta(days=1)
+
+    def at(self, moment: datetime.datetime) -> Dict[str, List[str]]:
+        """Все группы, которые запускаются в минуту moment"""
+        return self.by_minute.get(self.minute(moment), {})
+
+    def due(self, group: str, moment: datetime.datetime) -> List[str]:
+        return self.at(moment).get(group, [])
+
+
+# handler(job, {tg_id: название}, день запуска, часовой пояс точек)
+JobHandler = Callable[[JobDef, Dict[str, str], datetime.date, datetime.tzinfo], Awaitable]
+# planner(job, {tg_id: название}, день запуска, часовой пояс точек, момент запуска, заменить ли готовый план)
+JobPlanner = Callable[[JobDef, Dict[str, str], datetime.date, datetime.tzinfo, datetime.datetime, bool], Awaitable]
+
+
+class JobDispatcher:
+    """
+    Ставит задачи из JobBook в планировщик: одна задача планировщика на группу точек
+    с одинаковыми часовым поясом и временем. Группа по умолчанию называется как задача,
+    остальные - 'задача@пояс/ЧЧ:ММ'. Индекс и группы пересобираются раз в сутки в 0:00
+и при запуске, который устаревший индекс не покрывает.
+    Для задач с plan и зарегистрированным planner группа получает еще задачу 'группа:plan'
+    за plan минут до запуска: она заранее собирает рассылку ближайшего запуска.
+    """
+
+    def __init__(self, book: JobBook, job_scheduler: Scheduler):
+        self.book = book
+        self.scheduler = job_scheduler
+        self.index = DispatchIndex()
+        self.handlers: Dict[str, JobHandler] = {}
+        self.planners: Dict[str, JobPlanner] = {}
+        self._registered: Dict[str, Tuple[str, datetime.tzinfo, datetime.time]] = {}
+        self._planned: Dict[str, Tuple[str, datetime.tzinfo, datetime.time]] = {}
+
+    def register(self, kind: str, handler: JobHandler, planner: JobPlanner = None):
+        self.handlers[kind] = handler
+        if planner is not None:
+            self.planners[kind] = planner
+
+    def plans(self, group: str) -> bool:
+        job = self.book.jobs.get(self._registered.get(group, (group,))[0])
+        return job is not None and job.plan > 0 and job.kind in self.planners
+
+    def group_name(self, job_name: str, group_tz: datetime.tzinfo, at: datetime.time) -> str:
+        if self.book.is_default(job_name, group_tz, at):
+            return job_name
+        return f'{job_name}@{group_tz}/{at:%H:%M}'
+
+    def rebuild(self, now: datetime.datetime = None):
+        send_list = read_send_list_ids() or {}
+        groups = self.book.groups(send_list)
+        # Задачи по умолчанию ставятся и без точек: новые точки списка попадут в них
+        for name, job in self.book.jobs.items():
+            groups.setdefault((name, tz, job.at), [])
+        wanted = {self.group_name(*key): key for key in groups}
+        self.index.build({group: (key[1], key[2], groups[key]) for group, key in wanted.items()},
+                         now or datetime.datetime.now(tz=pytz.utc))
+
+        for group, key in wanted.items():
+            if self._registered.get(group) == key:
+                continue
+            name, group_tz, at = key
+            self.scheduler.add_job(group, at, self._fire, group, name, group_tz, job_tz=group_tz,
+                                   catch_up=datetime.timedelta(minutes=self.book.jobs[name].catch_up))
+        for group in set(self._registered) - set(wanted):
+            self.scheduler.remove_job(group)
+        self._registered = wanted
+
+        planned = {}
+        for group, key in wanted.items():
+            if not self.plans(group):
+                continue
+            name, group_tz, at = key
+            job = self.book.jobs[name]
+            planned[group] = key + (job.plan,)
+            if self._planned.get(group) == planned[group]:
+                continue
+            self.scheduler.add_job(f'{group}:plan', time_before(at, job.plan), self._plan, group, job_tz=group_tz,
+                                   catch_up=datetime.timedelta(minutes=job.catch_up))
+        for group in set(self._planned) - set(planned):
+            self.scheduler.remove_job(f'{group}:plan')
+        self._planned = planned
+        logger.info('Расписание: %s групп, планов %s, точек %s', len(wanted), len(planned), len(self.index.known))
+
+    async def reload(self):
+        try:
+            self.book.load()
+        except Exception as err:
+            err_log.error('Ошибка чтения %s, остаются прежние задачи: %s', self.book.path, err, exc_info=True)
+        self.rebuild()
+
+    def setup(self):
+        self.rebuild()
+        self.scheduler.add_job('jobs_rebuild', '0:00', self.reload)
+
+    def _cafes(self, group: str, job_name: str, moment: datetime.datetime) -> Dict[str, str]:
+        """Точки группы, которым задача отправляется в moment"""
+        if not self.index.covers(moment):
+            # Индекс устарел: например, лидером стал экземпляр, запущенный несколько дней назад,
+            # или сборка в 0:00 не выполнялась, пока экземпляр не был лидером
+            logger.info('Индекс запусков не покрывает %s, пересобираем', moment)
+            self.rebuild(moment)
+        send_list = read_send_list_ids() or {}
+        tg_ids = self.index.due(group, moment)
+        if group == job_name:
+            # Точки, добавленные в список после сборки индекса
+            tg_ids = tg_ids + [tg_id for tg_id in send_list
+                               if tg_id not in self.index.known and tg_id not in self.book.cafes]
+        return {tg_id: send_list[tg_id] for tg_id in tg_ids if tg_id in send_list}
+
+    async def _fire(self, group: str, job_name: str, group_tz: datetime.tzinfo):
+        job = self.book.jobs.get(job_name)
+        if job is None:
+            return
+        cafes = self._cafes(group, job_name, fire_time.get() or datetime.datetime.now(tz=pytz.utc))
+        if not cafes:
+            logger.debug('%s: нет точек', group)
+            return
+        await self.handlers[job.kind](job, cafes, scheduled_date(group_tz), group_tz)
+
+    async def _plan(self, group: str, replace: bool = False) -> int:
+        """Собирает план ближайшего запуска группы (после планового времени задачи плана)"""
+        scheduled = self.scheduler.jobs.get(group)
+        if scheduled is None or not self.plans(group):
+            return 0
+        job_name, group_tz, _ = self._registered[group]
+        job = self.book.jobs[job_name]
+        send_at = scheduled.next_fire(fire_time.get() or datetime.datetime.now(tz=pytz.utc))
+        cafes = self._cafes(group, job_name, send_at)
+        if not cafes:
+            logger.debug('%s: нет точек для плана', group)
+            return 0
+        return await self.planners[job.kind](job, cafes, send_at.astimezone(group_tz).date(), group_tz,
+                                             send_at, replace)
+
+    async def replan(self) -> int:
+        """Пересобирает планы ближайших запусков всех групп. Уже начатые отправки не меняются"""
+        planned = 0
+        for group in list(self._planned):
+            planned += await self._plan(group, replace=True)
+        return planned
+
+
+job_book = JobBook(conf.logic.jobs_config)
+job_dispatcher = JobDispatcher(job_book, scheduler)
@@ -0,0 +1,191 @@
+import abc
+import asyncio
+import datetime
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, List, Optional
+
+import pytz
+from sqlalchemy import update, delete, or_, select, func
+
+from config_data.conf import conf, get_my_loggers
+from database.db import async_session, Lease
+
+logger, err_log = get_my_loggers(__name__)
+
+
+class LeaseBackend(abc.ABC):
+    """
+    Хранилище аренды.
+    acquire() продлевает аренду, если она уже у holder, или занимает свободную/просроченную
+    """
+
+    @abc.abstractmethod
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def release(self, name: str, holder: str):
+        ...
+
+
+class LocalLease(LeaseBackend):
+    """Один экземпляр бота: аренда всегда его"""
+
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        return True
+
+    async def release(self, name: str, holder: str):
+        pass
+
+
+class DatabaseLease(LeaseBackend):
+    """
+    Аренда в таблице leases: занять можно только свою или просроченную строку - одним UPDATE.
+    Время берется у базы (CURRENT_TIMESTAMP, UTC): все экземпляры сравнивают сроки по одним часам,
+    и расхождение часов серверов не дает двух лидеров одновременно
+    """
+
+    @staticmethod
+    async def _now(session) -> datetime.datetime:
+        now = (await session.execute(select(func.current_timestamp()))).scalar_one()
+        # SQLite возвращает время без часового пояса - это UTC
+        if now.tzinfo is None:
+            return now.replace(tzinfo=pytz.utc)
+        return now.astimezone(pytz.utc)
+
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        async with async_session() as session:
+            now = await self._now(session)
+            expires_at = now + datetime.timedelta(seconds=ttl)
+            result = await session.execute(update(Lease).where(
+                Lease.name == name,
+                or_(Lease.holder == holder, Lease.expires_at < now),
+            ).values(holder=holder, expires_at=expires_at))
+            if result.rowcount:
+                await session.commit()
+                return True
+            if await session.get(Lease, name) is not None:
+                return False
+            session.add(Lease(name=name, holder=holder, expires_at=expires_at))
+            try:
+                await session.commit()
+            except Exception:
+                # Строку одновременно создал другой экземпляр
+                await session.rollback()
+                return False
+            return True
+
+    async def release(self, name: str, holder: str):
+        async with async_session() as session:
+            await session.execute(delete(Lease).where(Lease.name == name, Lease.holder == holder))
+            await session.commit()
+
+
+LEASE_BACKENDS = {
+    'db': DatabaseLease,
+    'local': LocalLease,
+}
+
+
+def get_lease_backend(name: str = None) -> LeaseBackend:
+    return LEASE_BACKENDS[name or conf.logic.leader_backend]()
+
+
+class LeaderElector:
+    """
+    Выбор лидера среди экземпляров бота через аренду name.
+    Лидер продлевает аренду каждые heartbeat секунд и выполняет задачи лидера (планировщик, очередь).
+    Если аренду занял другой или ее не удается продлить до истечения, задачи лидера останавливаются -
+    два лидера одновременно не работают. Остальные экземпляры пытаются занять аренду с тем же интервалом:
+    после падения лидера его место занимают не позже чем через ttl + heartbeat секунд,
+    после штатной остановки - через heartbeat.
+    Если задача лидера завершилась или упала, экземпляр слагает полномочия: останавливает остальные задачи,
+    освобождает аренду и ttl секунд не пытается ее занять - за это время лидером станет другой экземпляр,
+    а если других нет, этот перезапустит задачи.
+    """
+
+    def __init__(self, backend: LeaseBackend, name: str = 'scheduler', ttl: float = 10, heartbeat: float = 3):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.is_leader = False
+        self._tasks: List[asyncio.Task] = []
+        self._resign_until = 0.0
+
+    async def _acquire(self) -> Optional[bool]:
+        """True/False - результат, None - хранилище недоступно"""
+        try:
+            return await self.backend.acquire(self.name, self.holder, self.ttl)
+        except Exception as err:
+            err_log.error('Ошибка продления аренды %s: %s', self.name, err, exc_info=True)
+            return None
+
+    @staticmethod
+    def _log_crash(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            err_log.error('Задача лидера упала: %r', task.exception(), exc_info=task.exception())
+
+    def _start(self, factories):
+        logger.info('%s стал лидером %s', self.holder, self.name)
+        self.is_leader = True
+        self._tasks = [asyncio.create_task(factory()) for factory in factories]
+        for task in self._tasks:
+            task.add_done_callback(self._log_crash)
+
+    async def _stop(self, reason: str):
+        if not self.is_leader:
+            return
+        logger.warning('%s больше не лидер %s: %s', self.holder, self.name, reason)
+        self.is_leader = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _resign(self):
+        """Задача лидера завершилась: отдаем аренду другому экземпляру"""
+        await self._stop('задача лидера завершилась')
+        self._resign_until = time.monotonic() + self.ttl
+        try:
+            await self.backend.release(self.name, self.holder)
+        except Exception as err:
+            err_log.error('Не удалось освободить аренду %s: %s', self.name, err)
+
+    async def run(self, *factories: Callable[[], Awaitable]):
+        """Пока экземпляр лидер, выполняет корутины factories()"""
+        valid_until = 0.0
+        try:
+            while True:
+                if self.is_leader and any(task.done() for task in self._tasks):
+                    await self._resign()
+                if time.monotonic() < self._resign_until:
+                    await asyncio.sleep(self.heartbeat)
+                    continue
+                attempt = time.monotonic()
+                acquired = await self._acquire()
+                if acquired:
+                    valid_until = attempt + self.ttl
+                    if not self.is_leader:
+                        self._start(factories)
+                elif acquired is False:
+                    await self._stop('аренду занял другой экземпляр')
+                elif time.monotonic() + self.heartbeat >= valid_until:
+                    # Не успеем продлить до истечения аренды
+                    await self._stop('не удалось продлить аренду')
+                await asyncio.sleep(self.heartbeat)
+        finally:
+            was_leader = self.is_leader
+            await self._stop('остановка')
+            if was_leader:
+                try:
+                    await self.backend.release(self.name, self.holder)
+                except Exception as err:
+                    err_log.error('Не удалось освободить аренду %s: %s', self.name, err)
+
+
+leader = LeaderElector(get_lease_backend(), 'scheduler', conf.logic.leader_ttl, conf.logic.leader_heartbeat)
@@ -0,0 +1,243 @@
+"""
+Метрики бота в текстовом формате Prometheus (/metrics на METRICS_HOST:METRICS_PORT).
+- время и ошибки хендлеров (middleware диспетчера);
+- время запросов к базе по шаблону запроса (события движка SQLAlchemy);
+- длительность, результат и количество сообщений задач планировщика (job_metrics);
+- отправки очереди и ошибки Telegram (services.outbox, services.broadcast);
+- статистика кэша пользователей.
+При METRICS=false middleware и события движка не подключаются, job_metrics возвращает обработчик
+как есть, а inc/observe сразу выходят.
+"""
+import bisect
+import functools
+import re
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config_data.conf import conf, get_my_loggers
+from services.user_cache import user_cache
+
+logger, err_log = get_my_loggers(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+
+class Metrics:
+    """Реестр счетчиков, гистограмм и вычисляемых при запросе метрик"""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._meta: Dict[str, tuple] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self._histograms: Dict[Tuple[str, Labels], list] = {}
+        self._collectors: Dict[str, Callable[[], float]] = {}
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+
+    def collector(self, name: str, help_text: str, collect: Callable[[], float], kind: str = 'gauge'):
+        """Метрика без меток, значение которой вычисляется при запросе /metrics"""
+        self._meta[name] = (kind, help_text, None)
+        self._collectors[name] = collect
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        self._counters[(name, _labels(labels))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        series = self._histograms.get(key)
+        buckets = self._meta[name][2]
+        if series is None:
+            series = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> str:
+        by_name = defaultdict(list)
+        for (name, labels), value in self._counters.items():
+            by_name[name].append(f'{name}{_format_labels(labels)} {value:g}')
+        for (name, labels), (counts, total, count) in self._histograms.items():
+            cumulative = 0
+            for le, bucket_count in zip(self._meta[name][2] + (float('inf'),), counts):
+                cumulative += bucket_count
+                le_label = '+Inf' if le == float('inf') else f'{le:g}'
+                by_name[name].append(f'{name}_bucket{_format_labels(labels, (("le", le_label),))} {cumulative}')
+            by_name[name].append(f'{name}_sum{_format_labels(labels)} {total:.6f}')
+            by_name[name].append(f'{name}_count{_format_labels(labels)} {count}')
+        for name, collect in self._collectors.items():
+            try:
+                by_name[name].append(f'{name} {collect():g}')
+            except Exception as err:
+                logger.warning('Метрика %s не посчитана: %s', name, err)
+
+        lines = []
+        for name, (kind, help_text, _) in self._meta.items():
+            if name not in by_name:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(by_name[name])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(enabled=conf.logic.metrics_enabled)
+metrics.histogram('bot_handler_duration_seconds', 'Время обработки апдейта хендлером')
+metrics.counter('bot_handler_calls_total', 'Вызовы хендлеров по результату (ok/error)')
+metrics.histogram('bot_db_query_duration_seconds', 'Время запроса к базе по шаблону запроса')
+metrics.counter('bot_db_query_errors_total', 'Ошибки запросов к базе по шаблону запроса')
+metrics.histogram('bot_job_duration_seconds', 'Длительность задачи планировщика', JOB_BUCKETS)
+metrics.counter('bot_job_runs_total', 'Запуски задач планировщика по результату (ok/error)')
+metrics.counter('bot_job_messages_total', 'Сообщения, поставленные задачей в очередь рассылки')
+metrics.counter('bot_outbox_sent_total', 'Сообщения очереди, доставленные точкам')
+metrics.counter('bot_outbox_dead_total', 'Сообщения очереди, ушедшие в outbox_dead')
+metrics.counter('bot_telegram_errors_total', 'Ошибки Telegram API по методу и типу ошибки')
+metrics.collector('bot_user_cache_hits_total', 'Попадания в кэш пользователей',
+                  lambda: user_cache.hits, kind='counter')
+metrics.collector('bot_user_cache_misses_total', 'Промахи кэша пользователей',
+                  lambda: user_cache.misses, kind='counter')
+metrics.collector('bot_user_cache_size', 'Пользователей в кэше', lambda: user_cache.stats()['size'])
+
+
+def handler_name(data: Dict[str, Any]) -> str:
+    handler = data.get('handler')
+    callback = getattr(handler, 'callback', None)
+    if callback is None:
+        return 'unknown'
+    return f'{callback.__module__.rsplit(".", 1)[-1]}.{callback.__name__}'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время и результат каждого хендлера. Подключается как inner middleware: handler уже выбран"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        name = handler_name(data)
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            metrics.observe('bot_handler_duration_seconds', time.perf_counter() - started, handler=name)
+            metrics.inc('bot_handler_calls_total', handler=name, status=status)
+
+
+_IN_LIST = re.compile(r'\((?:\s*(?:\?|\$\d+|%s|%\(\w+\)s)\s*,)+\s*(?:\?|\$\d+|%s|%\(\w+\)s)\s*\)')
+_COLUMNS = re.compile(r'^SELECT (DISTINCT )?.+? FROM ')
+_NUMBER = re.compile(r'\b\d+\b')
+_SPACES = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    """Шаблон запроса: без лишних пробелов и списка колонок, числа и списки IN (?, ?, ...) свернуты"""
+    statement = _SPACES.sub(' ', statement).strip()
+    statement = _COLUMNS.sub(r'SELECT \1... FROM ', statement)
+    statement = _IN_LIST.sub('(?)', statement)
+    return _NUMBER.sub('N', statement)[:200]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is not None:
+        metrics.observe('bot_db_query_duration_seconds', time.perf_counter() - started,
+                        query=fingerprint(statement))
+
+
+def _handle_error(exception_context):
+    if exception_context.statement:
+        metrics.inc('bot_db_query_errors_total', query=fingerprint(exception_context.statement))
+
+
+def instrument(dp: Dispatcher, engine: AsyncEngine):
+    """Подключает middleware хендлеров и события движка. Без METRICS ничего не делает"""
+    if not metrics.enabled:
+        return
+    for observer in (dp.message, dp.callback_query, dp.my_chat_member, dp.chat_member):
+        observer.middleware(MetricsMiddleware())
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine.sync_engine, 'handle_error', _handle_error)
+
+
+def job_metrics(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """
+    Обертка обработчика задачи handler(job, ...): длительность, результат и количество
+    сообщений (если обработчик возвращает число) с меткой job.name
+    """
+    if not metrics.enabled:
+        return handler
+
+    @functools.wraps(handler)
+    async def wrapper(job, *args, **kwargs):
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            result = await handler(job, *args, **kwargs)
+            if isinstance(result, int):
+                metrics.inc('bot_job_messages_total', result, job=job.name)
+            return result
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            metrics.observe('bot_job_duration_seconds', time.perf_counter() - started, job=job.name)
+            metrics.inc('bot_job_runs_total', job=job.name, status=status)
+    return wrapper
+
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_server(host: str = None, port: int = None) -> Optional[web.AppRunner]:
+    """Запускает сервер /metrics. Без METRICS возвращает None"""
+    if not metrics.enabled:
+        return None
+    host = host or conf.logic.metrics_host
+    port = port or conf.logic.metrics_port
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_view)
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info('Метрики: http://%s:%s/metrics', host, port)
+    return runner
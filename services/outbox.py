@@ -0,0 +1,204 @@
+import asyncio
+import datetime
+from typing import Dict, List
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import select, update, delete, insert
+
+from config_data.conf import tz, get_my_loggers
+from database.db import async_session, OutboxMessage, DeadLetter
+from services.broadcast import broadcaster
+from services.delivery import execute_call
+from services.metrics import metrics
+
+logger, err_log = get_my_loggers(__name__)
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений в базе.
+    Задачи планировщика кладут сообщения через enqueue(), run() разбирает очередь пулом воркеров рассылки.
+    - ключ идемпотентности (задача, точка, дата): повторная постановка того же сообщения игнорируется;
+    - после каждого выполненного вызова сохраняется step, после перезапуска отправка продолжается с него;
+    - ошибки повторяются с экспоненциальной паузой, после max_attempts или блокировки бота
+      сообщение уходит в outbox_dead.
+    """
+
+    def __init__(self, batch_size: int = 200, max_attempts: int = 5, backoff: float = 30,
+                 poll_interval: float = 5, keep_days: int = 7):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.keep_days = keep_days
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def idempotency_key(job: str, chat_id, day: datetime.date) -> str:
+        return f'{job}:{chat_id}:{day.isoformat()}'
+
+    @staticmethod
+    def key_day(idempotency_key: str) -> datetime.date:
+        return datetime.date.fromisoformat(idempotency_key.rsplit(':', 1)[1])
+
+    async def enqueue(self, job: str, messages: Dict[str, List[dict]], day: datetime.date = None,
+                      not_before: datetime.datetime = None) -> int:
+        """
+        Ставит в очередь {chat_id: [вызовы]} одной транзакцией.
+        Возвращает количество новых сообщений (уже поставленные за day пропускаются)
+        """
+        now = datetime.datetime.now(tz=tz)
+        day = day or now.date()
+        # sqlite хранит время без пояса - все время очереди во времени бота
+        not_before = not_before.astimezone(tz) if not_before else now
+        keys = {chat_id: self.idempotency_key(job, chat_id, day) for chat_id in messages}
+        async with async_session() as session:
+            q = select(OutboxMessage.idempotency_key).where(OutboxMessage.idempotency_key.in_(keys.values()))
+            existing = set((await session.execute(q)).scalars().all())
+            rows = [{'idempotency_key': keys[chat_id], 'job': job, 'chat_id': str(chat_id), 'calls': calls,
+                     'step': 0, 'attempts': 0, 'status': 'pending', 'next_attempt_at': not_before,
+                     'created': now}
+                    for chat_id, calls in messages.items() if keys[chat_id] not in existing and calls]
+            if rows:
+                await session.execute(insert(OutboxMessage), rows)
+                await session.commit()
+        logger.info('Очередь %s: добавлено %s, уже было %s', job, len(rows), len(existing))
+        self.wake()
+        return len(rows)
+
+    async def queued(self, job: str, chat_ids, day: datetime.date) -> set:
+        """Точки из chat_ids, которым сообщение job за day уже поставлено в очередь"""
+        keys = {self.idempotency_key(job, chat_id, day): chat_id for chat_id in chat_ids}
+        async with async_session() as session:
+            q = select(OutboxMessage.idempotency_key).where(OutboxMessage.idempotency_key.in_(keys))
+            return {keys[key] for key in (await session.execute(q)).scalars().all()}
+
+    async def scheduled(self, jobs) -> List[OutboxMessage]:
+        """Сообщения задач jobs, время отправки которых еще не наступило (план рассылки)"""
+        async with async_session() as session:
+            q = select(OutboxMessage).where(
+                OutboxMessage.job.in_(jobs),
+                OutboxMessage.status == 'pending',
+                OutboxMessage.attempts == 0,
+                OutboxMessage.next_attempt_at > datetime.datetime.now(tz=tz),
+            ).order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+            return list((await session.execute(q)).scalars().all())
+
+    async def cancel(self, job: str, chat_ids, day: datetime.date) -> int:
+        """Удаляет еще не начатые сообщения job за day для chat_ids. Возвращает количество удаленных"""
+        keys = [self.idempotency_key(job, chat_id, day) for chat_id in chat_ids]
+        async with async_session() as session:
+            result = await session.execute(delete(OutboxMessage).where(
+                OutboxMessage.idempotency_key.in_(keys),
+                OutboxMessage.status == 'pending',
+                OutboxMessage.attempts == 0,
+                OutboxMessage.step == 0,
+            ))
+            await session.commit()
+        return result.rowcount
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _claim(self) -> List[OutboxMessage]:
+        now = datetime.datetime.now(tz=tz)
+        async with async_session() as session:
+            q = select(OutboxMessage).where(
+                OutboxMessage.status == 'pending',
+                OutboxMessage.next_attempt_at <= now,
+            ).order_by(OutboxMessage.next_attempt_at).limit(self.batch_size)
+            rows = (await session.execute(q)).scalars().all()
+            if rows:
+                await session.execute(update(OutboxMessage).where(
+                    OutboxMessage.id.in_([row.id for row in rows])).values(status='sending'))
+                await session.commit()
+        return list(rows)
+
+    async def _update(self, message_id: int, **values):
+        async with async_session() as session:
+            await session.execute(update(OutboxMessage).where(OutboxMessage.id == message_id).values(**values))
+            await session.commit()
+
+    async def _to_dead_letter(self, message: OutboxMessage, error: str):
+        async with async_session() as session:
+            session.add(DeadLetter(idempotency_key=message.idempotency_key, job=message.job,
+                                   chat_id=message.chat_id, calls=message.calls, step=message.step,
+                                   attempts=message.attempts, error=error[:1000],
+                                   created=datetime.datetime.now(tz=tz)))
+            await session.execute(update(OutboxMessage).where(OutboxMessage.id == message.id).values(
+                status='dead', attempts=message.attempts, last_error=error[:1000]))
+            await session.commit()
+        metrics.inc('bot_outbox_dead_total', job=message.job)
+        logger.warning('Сообщение %s не доставлено: %s', message.idempotency_key, error)
+
+    async def _deliver(self, bot: Bot, message: OutboxMessage):
+        try:
+            for step in range(message.step, len(message.calls)):
+                await execute_call(bot, message.chat_id, message.calls[step])
+                message.step = step + 1
+                if message.step < len(message.calls):
+                    await self._update(message.id, step=message.step)
+            await self._update(message.id, step=message.step, status='done', last_error=None)
+            metrics.inc('bot_outbox_sent_total', job=message.job)
+        except TelegramForbiddenError as err:
+            await self._to_dead_letter(message, str(err))
+        except Exception as err:
+            message.attempts += 1
+            if message.attempts >= self.max_attempts:
+                await self._to_dead_letter(message, str(err))
+                return
+            delay = self.backoff * 2 ** (message.attempts - 1)
+            if isinstance(err, TelegramRetryAfter):
+                delay = max(delay, err.retry_after)
+            logger.warning('Ошибка отправки %s (попытка %s), повтор через %s с.: %s',
+                           message.idempotency_key, message.attempts, delay, err)
+            await self._update(message.id, step=message.step, attempts=message.attempts, status='pending',
+                               last_error=str(err)[:1000],
+                               next_attempt_at=datetime.datetime.now(tz=tz) + datetime.timedelta(seconds=delay))
+
+    async def _cleanup(self):
+        border = datetime.datetime.now(tz=tz) - datetime.timedelta(days=self.keep_days)
+        async with async_session() as session:
+            await session.execute(delete(OutboxMessage).where(
+                OutboxMessage.status.in_(['done', 'dead']), OutboxMessage.created < border))
+            await session.commit()
+
+    async def drain(self, bot: Bot) -> int:
+        """Отправляет все сообщения, срок которых подошел. Возвращает количество обработанных"""
+        total = 0
+        while True:
+            messages = await self._claim()
+            if not messages:
+                return total
+            total += len(messages)
+            await broadcaster.broadcast({message.id: message for message in messages},
+                                        lambda message_id, message: self._deliver(bot, message), title='очередь')
+
+    async def run(self, bot: Bot):
+        """Воркер очереди: сообщения, прерванные при остановке бота, снова ставятся в работу"""
+        last_cleanup = None
+        while True:
+            self._wakeup.clear()
+            try:
+                if last_cleanup is None:
+                    # При старте: ошибка базы не останавливает воркер, повтор на следующем круге
+                    async with async_session() as session:
+                        await session.execute(update(OutboxMessage).where(
+                            OutboxMessage.status == 'sending').values(status='pending'))
+                        await session.commit()
+                    await self._cleanup()
+                    last_cleanup = datetime.datetime.now(tz=tz)
+                await self.drain(bot)
+                if datetime.datetime.now(tz=tz) - last_cleanup > datetime.timedelta(hours=1):
+                    await self._cleanup()
+                    last_cleanup = datetime.datetime.now(tz=tz)
+            except Exception as err:
+                err_log.error('Ошибка обработки очереди: %s', err, exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox = Outbox()
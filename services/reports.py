@@ -0,0 +1,117 @@
+import datetime
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set
+
+from sqlalchemy import select, func, and_, or_, false
+
+from config_data.conf import tz, get_my_loggers
+from database.db import User, async_session, Report
+from services.func import read_send_list_ids, local_day_range
+from services.jobs import job_book
+
+logger, err_log = get_my_loggers(__name__)
+
+
+@dataclass
+class PeriodReport:
+    """Соблюдение сроков точками за период start - end (включительно)"""
+    start: datetime.date
+    end: datetime.date
+    # {тип отчета: {tg_id: дни со сданным вовремя отчетом}}
+    done_days: Dict[str, Dict[str, Set[datetime.date]]] = field(default_factory=dict)
+    users: Dict[str, User] = field(default_factory=dict)
+    send_list: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def days(self) -> int:
+        return (self.end - self.start).days + 1
+
+    def missed(self, report_type: str) -> Dict[str, int]:
+        """{tg_id: количество дней без отчета} по всем точкам списка рассылки"""
+        done = self.done_days.get(report_type, {})
+        return {tg_id: self.days - len(done.get(tg_id, ())) for tg_id in self.send_list}
+
+
+async def get_period_report(days_ago: int = 7, report_types=None) -> PeriodReport:
+    """
+    Отчет за days_ago дней до сегодняшнего одним сгруппированным запросом:
+    (точка, тип, день) для отчетов, сданных в свое окно (job_book.windows с учетом настроек точек)
+    """
+    report_types = report_types or tuple(job_book.windows)
+    send_list = read_send_list_ids()
+    today = datetime.datetime.now(tz=tz).date()
+    start = today - datetime.timedelta(days=days_ago)
+    end = today - datetime.timedelta(days=1)
+    report = PeriodReport(start=start, end=end, send_list=send_list,
+                          done_days={report_type: {} for report_type in report_types})
+
+    hour = func.extract('hour', Report.date)
+    day = func.date(Report.date)
+    conditions = []
+    for report_type in report_types:
+        window_groups = job_book.window_groups(report_type, send_list)
+        for (start_hour, end_hour), tg_ids in window_groups.items():
+            condition = and_(Report.task_type == report_type, hour >= start_hour, hour < end_hour)
+            if len(window_groups) > 1:
+                condition = and_(condition, User.tg_id.in_(tg_ids))
+            conditions.append(condition)
+    in_window = or_(*conditions) if conditions else false()
+    q = select(User.tg_id, Report.task_type, day).join(Report, Report.user_id == User.id).where(
+        User.tg_id.in_(send_list),
+        Report.date >= local_day_range(start)[0],
+        Report.date < local_day_range(today)[0],
+        in_window,
+    ).group_by(User.tg_id, Report.task_type, day)
+    users_q = select(User).where(User.tg_id.in_(send_list))
+
+    async with async_session() as session:
+        for tg_id, report_type, report_day in await session.execute(q):
+            if isinstance(report_day, str):
+                report_day = datetime.date.fromisoformat(report_day)
+            report.done_days[report_type].setdefault(tg_id, set()).add(report_day)
+        report.users = {user.tg_id: user for user in (await session.execute(users_q)).scalars().all()}
+    logger.info('Отчет за %s дней: %s - %s', days_ago, report.start, report.end)
+    return report
+
+
+@dataclass
+class DayCompliance:
+    """Кто из списка рассылки не сдал отчеты за день"""
+    day: datetime.date
+    send_list: Dict[str, str] = field(default_factory=dict)
+    # Точки, которых нет в базе
+    unknown: Set[str] = field(default_factory=set)
+    # {тип отчета: tg_id точек без отчета}
+    noncompliant: Dict[str, Set[str]] = field(default_factory=dict)
+
+
+async def get_day_compliance(report_types=('вечер', 'бар'), day: datetime.date = None,
+                       start_hour: int = 0, end_hour: int = 23,
+                       cafes: Optional[Dict[str, str]] = None, day_tz=None) -> DayCompliance:
+    """
+    Проверка отчетов report_types за day в интервале [start_hour, end_hour) одним запросом:
+    точки (cafes, по умолчанию весь список рассылки) LEFT JOIN их отчеты нужных типов за интервал.
+    День и часы - в часовом поясе day_tz (по умолчанию бота)
+    """
+    send_list = cafes if cafes is not None else read_send_list_ids()
+    day = day or datetime.datetime.now(tz=day_tz or tz).date()
+    start, end = local_day_range(day, start_hour, end_hour, day_tz)
+    q = select(User.tg_id, Report.task_type).outerjoin(Report, and_(
+        Report.user_id == User.id,
+        Report.task_type.in_(report_types),
+        Report.date >= start,
+        Report.date < end,
+    )).where(User.tg_id.in_(send_list)).distinct()
+    async with async_session() as session:
+        rows = (await session.execute(q)).all()
+
+    known = {tg_id for tg_id, _ in rows}
+    done = {report_type: set() for report_type in report_types}
+    for tg_id, report_type in rows:
+        if report_type in done:
+            done[report_type].add(tg_id)
+    result = DayCompliance(day=day, send_list=send_list, unknown=set(send_list) - known)
+    for report_type in report_types:
+        result.noncompliant[report_type] = known - done[report_type]
+    logger.debug('Проверка %s за %s: %s', report_types, day, result.noncompliant)
+    return result
@@ -0,0 +1,218 @@
+import asyncio
+import contextvars
+import datetime
+import heapq
+import itertools
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import pytz
+from sqlalchemy import select
+
+from config_data.conf import tz, get_my_loggers
+from database.db import async_session, JobRun
+
+logger, err_log = get_my_loggers(__name__)
+
+# Плановое время текущего запуска (UTC). Задача может узнать, за какой день она запущена
+fire_time: contextvars.ContextVar[Optional[datetime.datetime]] = contextvars.ContextVar('fire_time', default=None)
+
+
+def scheduled_date(job_tz=tz) -> datetime.date:
+    """Дата планового запуска текущей задачи (или сегодня, если задача запущена не планировщиком)"""
+    fired = fire_time.get()
+    if fired is None:
+        return datetime.datetime.now(tz=job_tz).date()
+    return fired.astimezone(job_tz).date()
+
+
+def local_fire_time(day: datetime.date, at: datetime.time, job_tz: datetime.tzinfo) -> datetime.datetime:
+    """Момент day at в часовом поясе job_tz, в UTC"""
+    local = datetime.datetime.combine(day, at)
+    if isinstance(job_tz, pytz.BaseTzInfo):
+        local = job_tz.normalize(job_tz.localize(local))
+    else:
+        local = local.replace(tzinfo=job_tz)
+    return local.astimezone(pytz.utc)
+
+
+@dataclass
+class Job:
+    name: str
+    at: datetime.time
+    func: Callable[..., Awaitable]
+    args: tuple = ()
+    tz: datetime.tzinfo = tz
+    # Насколько поздно можно запустить пропущенный (например, во время простоя) запуск
+    catch_up: datetime.timedelta = datetime.timedelta(hours=1)
+    running: bool = field(default=False, init=False)
+
+    def fire_at(self, day: datetime.date) -> datetime.datetime:
+        """Время запуска в день day (в часовом поясе задачи), в UTC"""
+        return local_fire_time(day, self.at, self.tz)
+
+    def next_fire(self, after: datetime.datetime) -> datetime.datetime:
+        """Ближайший запуск строго после after"""
+        day = after.astimezone(self.tz).date() - datetime.timedelta(days=1)
+        while True:
+            fire = self.fire_at(day)
+            if fire > after:
+                return fire
+            day += datetime.timedelta(days=1)
+
+    def prev_fire(self, now: datetime.datetime) -> datetime.datetime:
+        """Последний плановый запуск не позже now"""
+        day = now.astimezone(self.tz).date() + datetime.timedelta(days=1)
+        while True:
+            fire = self.fire_at(day)
+            if fire <= now:
+                return fire
+            day -= datetime.timedelta(days=1)
+
+
+class Scheduler:
+    """
+    Планировщик ежедневных задач.
+    Держит кучу ближайших запусков и спит ровно до первого из них. Время задается в часовом поясе
+    задачи (по умолчанию часовой пояс бота). Каждый запуск идет отдельной задачей asyncio;
+    если предыдущий запуск той же задачи еще не закончился, новый пропускается.
+    Время запусков сохраняется в job_runs: запуск, пропущенный во время простоя,
+    выполняется после старта, если опоздание не больше catch_up.
+    """
+
+    max_sleep = 300
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        self._heap: List[Tuple[datetime.datetime, int, Job]] = []
+        self._counter = itertools.count()
+        self._tasks: set = set()
+        self._wakeup = asyncio.Event()
+
+    def add_job(self, name: str, at: Union[str, datetime.time], func: Callable[..., Awaitable], *args, job_tz=None,
+                catch_up: datetime.timedelta = datetime.timedelta(hours=1)) -> Job:
+        """
+        add_job('morning', '8:00', send_task, bot).
+        Задача с тем же именем заменяется
+        """
+        if isinstance(at, str):
+            hour, minute = map(int, at.split(':'))
+            at = datetime.time(hour, minute)
+        job = Job(name=name, at=at, func=func, args=args, tz=job_tz or tz, catch_up=catch_up)
+        self.jobs[name] = job
+        self._push(job, job.next_fire(self._now()))
+        self._wakeup.set()
+        return job
+
+    def remove_job(self, name: str):
+        self.jobs.pop(name, None)
+        self._wakeup.set()
+
+    @staticmethod
+    def _now() -> datetime.datetime:
+        return datetime.datetime.now(tz=pytz.utc)
+
+    def _push(self, job: Job, fire: datetime.datetime):
+        heapq.heappush(self._heap, (fire, next(self._counter), job))
+
+    async def _last_runs(self) -> Dict[str, datetime.datetime]:
+        async with async_session() as session:
+            rows = (await session.execute(select(JobRun))).scalars().all()
+        result = {}
+        for row in rows:
+            last_fire = row.last_fire
+            if last_fire.tzinfo is None:
+                last_fire = last_fire.replace(tzinfo=pytz.utc)
+            result[row.name] = last_fire
+        return result
+
+    async def _save_run(self, name: str, **values):
+        async with async_session() as session:
+            row = await session.get(JobRun, name)
+            if row is None:
+                row = JobRun(name=name)
+                session.add(row)
+            for key, value in values.items():
+                setattr(row, key, value.astimezone(pytz.utc) if value else value)
+            await session.commit()
+
+    async def catch_up(self):
+        """Запускает задачи, плановое время которых прошло во время простоя"""
+        now = self._now()
+        last_runs = await self._last_runs()
+        for job in list(self.jobs.values()):
+            last_fire = last_runs.get(job.name)
+            if last_fire is None:
+                # Новая задача - запоминаем, чтобы не запускать задним числом
+                await self._save_run(job.name, last_fire=job.prev_fire(now))
+                continue
+            missed = job.prev_fire(now)
+            if missed > last_fire and now - missed <= job.catch_up:
+                logger.info('Догоняющий запуск %s за %s', job.name, missed)
+                self._start(job, missed)
+
+    def _start(self, job: Job, fire: datetime.datetime):
+        if job.running:
+            logger.warning('Задача %s еще выполняется, запуск за %s пропущен', job.name, fire)
+            return
+        task = asyncio.create_task(self._run_job(job, fire))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_job(self, job: Job, fire: datetime.datetime):
+        job.running = True
+        fire_time.set(fire)
+        started = self._now()
+        try:
+            await self._save_run(job.name, last_fire=fire, started=started, finished=None)
+            logger.info('Запуск %s (план %s)', job.name, fire.astimezone(job.tz))
+            await job.func(*job.args)
+            await self._save_run(job.name, last_fire=fire, started=started, finished=self._now())
+        except Exception as err:
+            err_log.error('Ошибка задачи %s: %s', job.name, err, exc_info=True)
+        finally:
+            job.running = False
+
+    async def run(self):
+        """
+        Основной цикл. Можно остановить (отменой) и запустить снова, например при смене лидера:
+        ближайшие запуски пересчитываются от текущего момента, пропущенные догоняются через catch_up.
+        При остановке отменяются и уже запущенные задачи - бывший лидер не продолжает рассылку
+        """
+        try:
+            await self._loop()
+        finally:
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _loop(self):
+        now = self._now()
+        self._heap = []
+        for job in self.jobs.values():
+            self._push(job, job.next_fire(now))
+        try:
+            await self.catch_up()
+        except Exception as err:
+            err_log.error('Ошибка догоняющих запусков: %s', err, exc_info=True)
+        while True:
+            now = self._now()
+            while self._heap and self._heap[0][0] <= now:
+                fire, _, job = heapq.heappop(self._heap)
+                if self.jobs.get(job.name) is not job:
+                    # Задача удалена или заменена
+                    continue
+                self._start(job, fire)
+                self._push(job, job.next_fire(now))
+            delay = self.max_sleep
+            if self._heap:
+                delay = min(delay, (self._heap[0][0] - now).total_seconds())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+
+scheduler = Scheduler()
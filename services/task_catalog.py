@@ -0,0 +1,80 @@
+import bisect
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+
+from config_data.conf import get_my_loggers
+from database.db import async_session, Task
+
+logger, err_log = get_my_loggers(__name__)
+
+
+@dataclass
+class TaskPage:
+    items: List[Tuple[int, str]]  # (id, название)
+    start: int  # Сколько задач до страницы
+    total: int
+    size: int
+    prev_after: Optional[int]  # after_id предыдущей страницы, None - это первая
+    next_after: Optional[int]  # after_id следующей страницы, None - это последняя
+
+    @property
+    def number(self) -> int:
+        # После удалений страница может начинаться не с кратного size - считаем ее следующей
+        return min(math.ceil(self.start / self.size) + 1, self.pages)
+
+    @property
+    def pages(self) -> int:
+        return max(math.ceil(self.total / self.size), 1)
+
+
+class TaskCatalog:
+    """
+    Каталог задач для админки: (id, название) по возрастанию id и их количество.
+    Загружается одним запросом при первом обращении и сбрасывается через invalidate() при изменении таблицы.
+    Страницы выбираются по ключу - задачи с id больше after_id - бинарным поиском по списку.
+    """
+
+    def __init__(self, page_size: int = 20):
+        self.page_size = page_size
+        self._items: Optional[List[Tuple[int, str]]] = None
+        self._ids: List[int] = []
+        self._version = 0
+
+    def invalidate(self):
+        self._items = None
+        self._version += 1
+
+    async def items(self) -> List[Tuple[int, str]]:
+        items = self._items
+        if items is None:
+            version = self._version
+            async with async_session() as session:
+                rows = (await session.execute(select(Task.id, Task.title).order_by(Task.id))).all()
+            items = [(task_id, title) for task_id, title in rows]
+            # Если во время запроса был invalidate(), результат мог устареть - не кэшируем его
+            if version == self._version:
+                self._items, self._ids = items, [task_id for task_id, _ in items]
+            logger.debug('Каталог задач загружен: %s', len(items))
+        return items
+
+    async def count(self) -> int:
+        return len(await self.items())
+
+    async def page(self, after_id: int = 0) -> TaskPage:
+        """Страница задач с id больше after_id"""
+        items = await self.items()
+        ids = self._ids if items is self._items else [task_id for task_id, _ in items]
+        size = self.page_size
+        start = bisect.bisect_right(ids, after_id)
+        page_items = items[start:start + size]
+        prev_after = None
+        if start > 0:
+            prev_after = ids[start - size - 1] if start > size else 0
+        next_after = page_items[-1][0] if start + size < len(items) else None
+        return TaskPage(page_items, start, len(items), size, prev_after, next_after)
+
+
+task_catalog = TaskCatalog()
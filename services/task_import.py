@@ -0,0 +1,268 @@
+"""
+Массовое добавление блюд-задач.
+Источники:
+- zip-архив с manifest.csv или manifest.json и файлами медиа;
+- отдельный manifest.csv / manifest.json, где file - ссылка (http...) или file_id Telegram (сохраняется как есть);
+- альбомы или отдельные фото/видео с подписями: первая строка подписи - название, остальное - текст.
+
+manifest.csv: колонки file, title, text (и необязательная type: image или video), первая строка - заголовок.
+manifest.json: [{"file": "borsch.jpg", "title": "Борщ", "text": "..."}, ...]
+
+Файлы и ссылки загружаются в Telegram альбомами по 10 параллельно (import_concurrency), чтобы получить file_id.
+Загрузки идут в один чат, поэтому ограничены только общим лимитом рассылки, без лимита на чат.
+Все задачи сохраняются одним INSERT в одной транзакции.
+"""
+import asyncio
+import csv
+import io
+import json
+import re
+import time
+import zipfile
+from dataclasses import dataclass, field
+from pathlib import PurePosixPath
+from typing import List, Protocol, Sequence, Union
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile, InputMediaPhoto, InputMediaVideo, Message
+
+from config_data.conf import conf, get_my_loggers
+from services.broadcast import broadcaster
+from services.db_func import task_db_save_many
+from services.delivery import MAX_ALBUM_SIZE, MAX_CAPTION_LENGTH
+
+logger, err_log = get_my_loggers(__name__)
+
+MANIFEST_NAMES = ('manifest.csv', 'manifest.json')
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.m4v', '.webm'}
+MAX_TITLE_LENGTH = 100
+MAX_TEXT_LENGTH = 4000
+# file_id Telegram: длинная строка base64url без точек и пробелов
+FILE_ID_RE = re.compile(r'[A-Za-z0-9_-]{20,}')
+
+
+class TaskImportError(Exception):
+    pass
+
+
+@dataclass
+class ImportItem:
+    title: str
+    text: str
+    type: str  # image или video
+    source: Union[str, bytes, None] = None  # Содержимое файла, ссылка или file_id для загрузки
+    filename: str = ''
+    file_id: str = ''
+    error: str = ''
+
+    def row(self) -> dict:
+        return {'title': self.title[:MAX_TITLE_LENGTH], 'text': self.text[:MAX_TEXT_LENGTH] or '-',
+                'image': self.file_id, 'type': self.type}
+
+
+@dataclass
+class ImportResult:
+    saved: int = 0
+    failed: List[str] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        text = f'Добавлено блюд: {self.saved}'
+        if self.failed:
+            text += f'\nНе добавлено {len(self.failed)}:\n' + '\n'.join(self.failed[:30])
+        return text
+
+
+def failure(item: ImportItem) -> str:
+    return f'{item.title or item.filename or "-"}: {item.error or "нет file_id"}'
+
+
+def media_type(filename: str, declared: str = '') -> str:
+    if declared in ('image', 'video'):
+        return declared
+    return 'video' if PurePosixPath(filename).suffix.lower() in VIDEO_EXTENSIONS else 'image'
+
+
+def parse_manifest(data: bytes, name: str) -> List[dict]:
+    """Строки манифеста: [{'file': ..., 'title': ..., 'text': ..., 'type': ...}]"""
+    text = data.decode('utf-8-sig')
+    if name.lower().endswith('.json'):
+        rows = json.loads(text)
+        if not isinstance(rows, list):
+            raise TaskImportError('manifest.json должен быть списком')
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    for num, row in enumerate(rows, start=1):
+        if not isinstance(row, dict) or not row.get('file') or not row.get('title'):
+            raise TaskImportError(f'Строка {num} манифеста: нужны file и title')
+    return rows
+
+
+def items_from_manifest(rows: Sequence[dict], files: dict = None) -> List[ImportItem]:
+    """files - содержимое архива {имя: байты}. file из манифеста ищется в архиве, иначе это ссылка или file_id"""
+    files = files or {}
+    items = []
+    for row in rows:
+        file = str(row['file']).strip()
+        item = ImportItem(title=str(row['title']).strip(), text=str(row.get('text') or '').strip(),
+                          type=media_type(file, str(row.get('type') or '')), filename=PurePosixPath(file).name)
+        if file in files:
+            item.source = files[file]
+        elif file.startswith(('http://', 'https://')):
+            item.source = file
+        elif FILE_ID_RE.fullmatch(file):
+            # file_id Telegram: загружать не нужно
+            item.file_id = file
+        else:
+            item.error = 'файл не найден в архиве' if files else 'неверная ссылка или file_id'
+        items.append(item)
+    return items
+
+
+def read_archive(data: bytes) -> List[ImportItem]:
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        names = {PurePosixPath(name).name: name for name in archive.namelist() if not name.endswith('/')}
+        manifest = next((names[name] for name in MANIFEST_NAMES if name in names), None)
+        if manifest is None:
+            raise TaskImportError('В архиве нет manifest.csv или manifest.json')
+        rows = parse_manifest(archive.read(manifest), manifest)
+        wanted = {str(row['file']).strip() for row in rows}
+        # Путь в манифесте - относительно архива или просто имя файла
+        files = {}
+        for file in wanted:
+            path = file if file in archive.namelist() else names.get(PurePosixPath(file).name)
+            if path:
+                files[file] = archive.read(path)
+    return items_from_manifest(rows, files)
+
+
+def read_document(data: bytes, name: str) -> List[ImportItem]:
+    """Задачи из присланного файла: zip-архива или манифеста со ссылками и file_id"""
+    try:
+        if name.lower().endswith('.zip'):
+            return read_archive(data)
+        if name.lower().endswith(('.csv', '.json')):
+            return items_from_manifest(parse_manifest(data, name))
+    except (ValueError, KeyError, csv.Error, zipfile.BadZipFile) as err:
+        raise TaskImportError(f'Файл не прочитан: {err}') from err
+    raise TaskImportError('Нужен zip-архив, manifest.csv или manifest.json')
+
+
+def items_from_messages(messages: Sequence[Message]) -> List[ImportItem]:
+    """Задачи из фото/видео с подписями: file_id уже есть, загрузка не нужна"""
+    items = []
+    for message in messages:
+        lines = (message.caption or '').strip().split('\n', 1)
+        item = ImportItem(title=lines[0].strip(), text=lines[1].strip() if len(lines) > 1 else '', type='image')
+        if message.photo:
+            item.file_id = message.photo[-1].file_id
+        elif message.video:
+            item.file_id, item.type = message.video.file_id, 'video'
+        else:
+            item.error = 'не фото и не видео'
+        if not item.title and not item.error:
+            item.error = 'нет подписи'
+        items.append(item)
+    return items
+
+
+class Progress:
+    """Сообщение с ходом импорта, обновляется не чаще раза в interval секунд"""
+
+    def __init__(self, message: Message, interval: float = 1.0):
+        self.message = message
+        self.interval = interval
+        self._updated = 0.0
+
+    async def __call__(self, done: int, total: int, force: bool = False):
+        if not force and time.monotonic() - self._updated < self.interval:
+            return
+        self._updated = time.monotonic()
+        try:
+            await self.message.edit_text(f'Загрузка медиа: {done}/{total}')
+        except Exception as err:
+            logger.debug('Прогресс импорта не обновлен: %s', err)
+
+
+class ProgressCallback(Protocol):
+    async def __call__(self, done: int, total: int, force: bool = False): ...
+
+
+class TaskImporter:
+    """Загрузка медиа альбомами параллельно (не больше concurrency альбомов одновременно) и сохранение задач"""
+
+    def __init__(self, concurrency: int = 4):
+        self.concurrency = concurrency
+
+    @staticmethod
+    def _media(item: ImportItem):
+        source = item.source
+        if isinstance(source, bytes):
+            source = BufferedInputFile(source, filename=item.filename or 'media')
+        caption = item.title[:MAX_CAPTION_LENGTH]
+        if item.type == 'video':
+            return InputMediaVideo(media=source, caption=caption)
+        return InputMediaPhoto(media=source, caption=caption)
+
+    async def _upload_album(self, bot: Bot, chat_id, album: List[ImportItem]):
+        if len(album) == 1:
+            item = album[0]
+            media = self._media(item)
+            method = bot.send_video if item.type == 'video' else bot.send_photo
+            messages = [await broadcaster.call(chat_id, method, chat_limit=False, chat_id=chat_id,
+                                               **{'video' if item.type == 'video' else 'photo': media.media},
+                                               caption=media.caption)]
+        else:
+            messages = await broadcaster.call(chat_id, bot.send_media_group, chat_limit=False, chat_id=chat_id,
+                                              media=[self._media(item) for item in album])
+        for item, message in zip(album, messages):
+            if message.photo:
+                item.file_id = message.photo[-1].file_id
+            elif message.video:
+                item.file_id = message.video.file_id
+            else:
+                item.error = 'Telegram не вернул file_id'
+
+    async def upload(self, bot: Bot, chat_id, items: Sequence[ImportItem], progress: ProgressCallback = None):
+        """Загружает в чат chat_id медиа задач без file_id и заполняет file_id"""
+        pending = [item for item in items if not item.file_id and not item.error]
+        albums = [pending[i:i + MAX_ALBUM_SIZE] for i in range(0, len(pending), MAX_ALBUM_SIZE)]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        done = 0
+
+        async def upload_album(album: List[ImportItem]):
+            nonlocal done
+            async with semaphore:
+                try:
+                    await self._upload_album(bot, chat_id, album)
+                except Exception as err:
+                    logger.warning('Альбом импорта не загружен: %s', err)
+                    for item in album:
+                        item.error = str(err)[:200]
+            done += len(album)
+            if progress:
+                await progress(done, len(pending))
+
+        await asyncio.gather(*[upload_album(album) for album in albums])
+        if progress and pending:
+            await progress(done, len(pending), force=True)
+
+    async def save(self, items: Sequence[ImportItem]) -> ImportResult:
+        result = ImportResult()
+        rows = []
+        for item in items:
+            if item.error or not item.file_id:
+                result.failed.append(failure(item))
+            else:
+                rows.append(item.row())
+        result.saved = await task_db_save_many(rows)
+        logger.info('Импорт задач: сохранено %s, ошибок %s', result.saved, len(result.failed))
+        return result
+
+    async def run(self, bot: Bot, chat_id, items: Sequence[ImportItem],
+                  progress: ProgressCallback = None) -> ImportResult:
+        await self.upload(bot, chat_id, items, progress)
+        return await self.save(items)
+
+
+task_importer = TaskImporter(concurrency=conf.logic.import_concurrency)
@@ -0,0 +1,84 @@
+import random
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+
+from config_data.conf import conf, get_my_loggers
+from database.db import async_session, Task
+
+logger, err_log = get_my_loggers(__name__)
+
+
+class TaskSampler:
+    """
+    Выбор случайных задач без загрузки всей таблицы.
+    Держит в памяти только список id задач (сбрасывается через invalidate() при изменении таблицы),
+    выбранные задачи достает одним запросом IN.
+    В режиме rotation у каждой точки своя колода: задачи не повторяются, пока колода не закончится.
+    """
+
+    def __init__(self, mode: str = 'random'):
+        self.mode = mode
+        self._ids: Optional[List[int]] = None
+        self._version = 0
+        self._decks: Dict[str, dict] = {}
+
+    def invalidate(self):
+        self._ids = None
+        self._version += 1
+
+    async def get_ids(self) -> List[int]:
+        ids = self._ids
+        if ids is None:
+            version = self._version
+            async with async_session() as session:
+                ids = list((await session.execute(select(Task.id))).scalars().all())
+            # Если во время запроса был invalidate(), результат мог устареть - не кэшируем его
+            if version == self._version:
+                self._ids = ids
+            logger.debug('Загружено %s id задач', len(ids))
+        return ids
+
+    async def _draw_from_deck(self, key: str, k: int) -> List[int]:
+        ids = await self.get_ids()
+        deck = self._decks.get(key)
+        if deck is None:
+            deck = {'remaining': random.sample(ids, len(ids)), 'known': set(ids), 'version': self._version}
+            self._decks[key] = deck
+        elif deck['version'] != self._version:
+            ids_set = set(ids)
+            new_ids = list(ids_set - deck['known'])
+            random.shuffle(new_ids)
+            deck['remaining'] = [i for i in deck['remaining'] if i in ids_set] + new_ids
+            deck['known'] = ids_set
+            deck['version'] = self._version
+
+        chosen = deck['remaining'][:k]
+        deck['remaining'] = deck['remaining'][k:]
+        if len(chosen) < k:
+            # Колода закончилась - новый круг без задач, уже выбранных в этот раз
+            rest = [i for i in ids if i not in chosen]
+            random.shuffle(rest)
+            need = k - len(chosen)
+            chosen += rest[:need]
+            deck['remaining'] = rest[need:]
+        return chosen
+
+    async def sample_ids(self, k: int, key: str = None) -> List[int]:
+        """k разных id задач. key - точка для режима rotation"""
+        if self.mode == 'rotation' and key is not None:
+            return await self._draw_from_deck(str(key), k)
+        ids = await self.get_ids()
+        return random.sample(ids, min(k, len(ids)))
+
+    async def get_tasks(self, k: int, key: str = None) -> List[Task]:
+        task_ids = await self.sample_ids(k, key)
+        if not task_ids:
+            return []
+        async with async_session() as session:
+            q = select(Task).where(Task.id.in_(task_ids))
+            tasks = {task.id: task for task in (await session.execute(q)).scalars().all()}
+        return [tasks[task_id] for task_id in task_ids if task_id in tasks]
+
+
+task_sampler = TaskSampler(mode=conf.logic.task_sampling)
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+from config_data.conf import conf
+
+
+class UserCache:
+    """
+    LRU-кэш пользователей по tg_id с временем жизни записи ttl секунд.
+    Заполняется в check_user, обновляется при создании пользователя и в User.set
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, tg_id):
+        key = str(tg_id)
+        item = self._items.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, user):
+        if user is None or self.maxsize <= 0:
+            return
+        key = str(user.tg_id)
+        self._items[key] = (time.monotonic() + self.ttl, user)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def invalidate(self, tg_id=None):
+        if tg_id is None:
+            self._items.clear()
+        else:
+            self._items.pop(str(tg_id), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._items),
+            'hit_rate': round(self.hits / total, 3) if total else 0,
+        }
+
+
+user_cache = UserCache(maxsize=conf.logic.user_cache_size, ttl=conf.logic.user_cache_ttl)
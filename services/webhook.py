@@ -0,0 +1,115 @@
+import asyncio
+import secrets
+import signal
+from contextlib import suppress
+from typing import Any, Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config_data.conf import conf, get_my_loggers
+
+logger, err_log = get_my_loggers(__name__)
+
+# Ограничение Telegram на max_connections в setWebhook
+MAX_TELEGRAM_CONNECTIONS = 100
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука: Telegram получает ответ сразу, апдейт обрабатывается в фоне.
+    Одновременно обрабатывается не больше max_concurrency апдейтов - следующий запрос ждет
+    свободного места, и Telegram не шлет новые апдейты, пока не получит ответ.
+    При остановке сервер перестает принимать запросы и дожидается начатых апдейтов (не дольше drain_timeout).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str = None,
+                 max_concurrency: int = 64, drain_timeout: float = 30, **data: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self.drain_timeout = drain_timeout
+        self._semaphore = asyncio.BoundedSemaphore(max_concurrency)
+
+    async def _feed_update(self, bot: Bot, update: Dict[str, Any]):
+        try:
+            await self._background_feed_update(bot=bot, update=update)
+        except Exception as err:
+            err_log.error('Ошибка обработки апдейта %s: %s', update.get("update_id"), err, exc_info=True)
+        finally:
+            self._semaphore.release()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._feed_update(bot, update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def drain(self):
+        """Ждет апдейты, которые уже обрабатываются"""
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info('Ждем обработку %s апдейтов', len(tasks))
+        done, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        if pending:
+            logger.warning('Не дождались %s апдейтов за %s с., отменяем', len(pending), self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def close(self):
+        await self.drain()
+        await super().close()
+
+
+def build_app(bot: Bot, dp: Dispatcher, secret: str) -> web.Application:
+    settings = conf.webhook
+    app = web.Application()
+    handler = BoundedRequestHandler(dp, bot, secret_token=secret, max_concurrency=settings.max_concurrency,
+                                    drain_timeout=settings.drain_timeout)
+    handler.register(app, path=settings.path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, allowed_updates: List[str]):
+    """
+    Принимает апдейты через вебхук до SIGINT/SIGTERM.
+    Несколько экземпляров бота за балансировщиком должны иметь одинаковый WEBHOOK_SECRET.
+    Без WEBHOOK_SECRET случайный секрет создается, только если вебхук регистрирует сам бот (WEBHOOK_URL),
+    иначе заголовок секрета не проверяется
+    """
+    settings = conf.webhook
+    secret = settings.secret or None
+    if secret is None and settings.base_url:
+        secret = secrets.token_urlsafe(32)
+    elif secret is None:
+        logger.warning('WEBHOOK_SECRET не задан, вебхук зарегистрирован вне бота: секрет не проверяется')
+    runner = web.AppRunner(build_app(bot, dp, secret), handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.host, settings.port)
+    await site.start()
+    logger.info('Вебхук слушает %s:%s%s', settings.host, settings.port, settings.path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        if settings.base_url:
+            await bot.set_webhook(f'{settings.base_url.rstrip("/")}{settings.path}', secret_token=secret,
+                                  allowed_updates=allowed_updates,
+                                  max_connections=min(settings.max_concurrency, MAX_TELEGRAM_CONNECTIONS))
+            logger.info('Вебхук зарегистрирован: %s', settings.base_url)
+        await stop.wait()
+        logger.info('Остановка вебхука')
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError):
+                loop.remove_signal_handler(sig)
+        # Сервер перестает принимать запросы, затем on_shutdown дожидается начатых апдейтов
+        await runner.cleanup()
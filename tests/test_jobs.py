@@ -0,0 +1,38 @@
+import asyncio
+import datetime
+
+import pytz
+
+from benchmarks.common import setup_env, use_send_list
+
+setup_env()
+
+from config_data.conf import conf, tz  # noqa: E402
+from services.jobs import JobBook, JobDispatcher  # noqa: E402
+from services.scheduler import Scheduler, fire_time, local_fire_time  # noqa: E402
+
+
+def test_fire_after_index_expired():
+    """Запуск через 3 дня после сборки индекса находит точки: индекс пересобирается"""
+    use_send_list({'7000000001': 'Точка 1', '7000000002': 'Точка 2'})
+    dispatcher = JobDispatcher(JobBook(conf.logic.jobs_config), Scheduler())
+    calls = []
+
+    async def handler(job, cafes, day, cafe_tz):
+        calls.append((job.name, dict(cafes), day))
+
+    dispatcher.register('tasks', handler)
+    built = datetime.datetime(2026, 1, 10, 12, 0, tzinfo=pytz.utc)
+    dispatcher.rebuild(built)
+
+    day = built.astimezone(tz).date() + datetime.timedelta(days=3)
+    fire = local_fire_time(day, dispatcher.book.jobs['morning'].at, tz)
+    assert not dispatcher.index.covers(fire)
+
+    async def run():
+        fire_time.set(fire)
+        await dispatcher._fire('morning', 'morning', tz)
+
+    asyncio.run(run())
+    assert calls == [('morning', {'7000000001': 'Точка 1', '7000000002': 'Точка 2'}, day)]
+    assert dispatcher.index.covers(fire)